@@ -9,6 +9,8 @@
 # ==============================================================================
 #                                IMPORTS
 # ==============================================================================
+import os
+
 import torch
 from datasets import load_dataset
 from transformers import pipeline
@@ -27,18 +29,27 @@ CHECKPOINT = 'eevvgg/PaReS-sentimenTw-political-PL'
 def main():
     tokenizer = AutoTokenizer.from_pretrained(CHECKPOINT)
     model = AutoModelForSequenceClassification.from_pretrained(CHECKPOINT)
+    model.eval()
+    # Dynamic quantization stores weights of linear layers (which dominate
+    # BERT-like models) as int8, activations are quantized on the fly so no
+    # calibration data is needed.
+    model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear},
+                                                dtype=torch.qint8)
+    torch.set_num_threads(os.cpu_count() or 1)
     
     print('Wpisz wypowiedź by otrzymać ocenę jej wydźwięku albo "STOP" '
           'żeby zakończyć działanie programu.')
-    while True:
-        sentence = input('Wypowiedź ->')
-        if sentence == 'STOP':
-            break
-        tokens = tokenizer(sentence, return_tensors="pt")
-        output = model(**tokens)
-        predictions = torch.nn.functional.softmax(output.logits, dim=-1)
-        classification = predictions.argmax(1)
-        print(f'Twoja wypowiedź ma {PL_LABEL_NAMES[int(classification.item())]} charakter.')    
+    # Model is never trained here, so autograd bookkeeping is pure overhead
+    with torch.inference_mode():
+        while True:
+            sentence = input('Wypowiedź ->')
+            if sentence == 'STOP':
+                break
+            tokens = tokenizer(sentence, return_tensors="pt")
+            output = model(**tokens)
+            predictions = torch.nn.functional.softmax(output.logits, dim=-1)
+            classification = predictions.argmax(1)
+            print(f'Twoja wypowiedź ma {PL_LABEL_NAMES[int(classification.item())]} charakter.')    
 
 if __name__ == '__main__':
     main()
@@ -6,60 +6,269 @@
 # ==============================================================================
 from __future__ import annotations
 
-from dataclasses import dataclass
-from typing import FrozenSet,Dict,List,Set
+import glob
+import hashlib
+import importlib.util
+import json
+import logging
+import mmap
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import (Any,DefaultDict,FrozenSet,Dict,Hashable,Iterable,Iterator,
+                    List,NamedTuple,Optional,Set,Tuple)
 
 import faiss
+import faiss.contrib.torch_utils # Lets FAISS indexes take torch tensors
+import numpy as np
 import torch
 
 from sentence_transformers import SentenceTransformer
-from transformers import AutoTokenizer, AutoModelForCausalLM, TextGenerationPipeline
+from transformers import (AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig,
+                          TextIteratorStreamer)
 
 
 # ==============================================================================
 #                                KNOWLEDGE BASE
 # ==============================================================================
-@dataclass
-class RelevanceScore:
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+# Knowledge bases up to this size are searched with a plain matrix product,
+# for such sizes FAISS call overhead costs more than the search itself.
+BRUTE_FORCE_MAX_SIZE = 10_000
+# FAISS index is moved to GPU (if there is one) only above this size.
+GPU_INDEX_MIN_SIZE = 100_000
+# Compiling encoder removes per operation dispatch overhead of eager mode,
+# but first queries get much slower, so it only pays off for long sessions.
+COMPILE_ENCODER = False
+# Interactive sessions tend to repeat queries, so their embeddings and
+# retrieved contexts are cached.
+QUERY_CACHE_SIZE = 256
+CONTEXT_CACHE_TTL = 300.0 # seconds
+# Knowledge file section header, e.g. "[ROOM ACCESS]"
+SECTION_HEADER_RE = re.compile(r'^\[(.*)\]$')
+# Embeddings cache of knowledge file is "<file>.<config hash>.<mtime>.faiss"
+# (and JSON file), config being the model and keywords mode
+CACHE_SUFFIX_RE = re.compile(r'\.[0-9a-f]{16}\.[0-9]+\.faiss')
+# Flat indexes are only memory mapped with IO_FLAG_MMAP_IFC, older FAISS
+# versions without it read whole file
+INDEX_MMAP_FLAG = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP)
+
+
+class LRUCache:
+    '''Least recently used cache with optional time to live of entries.'''
+
+    _entries: OrderedDict[Hashable,Tuple[float,Any]]
+    _max_size: int
+    _ttl: Optional[float]
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None)-> None:
+        self._entries = OrderedDict()
+        self._max_size = max_size
+        self._ttl = ttl
+
+    def get(self, key: Hashable, default: Any = None)-> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        stored_at, value = entry
+        if self._ttl is not None and time.monotonic() - stored_at > self._ttl:
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Any)-> None:
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+
+# Models loaded by name are shared by all knowledge bases in the process
+_MODEL_CACHE: Dict[str,SentenceTransformer] = {}
+_MODEL_CACHE_LOCK = threading.Lock()
+
+def get_sentence_transformer(name: str)-> SentenceTransformer:
+    with _MODEL_CACHE_LOCK:
+        embed_model = _MODEL_CACHE.get(name)
+        if embed_model is not None:
+            return embed_model
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        embed_model = SentenceTransformer(name, device=device)
+        if device == 'cuda':
+            # Half precision halves memory traffic of encoder weights
+            embed_model = embed_model.half()
+        if COMPILE_ENCODER:
+            transformer = embed_model._first_module()
+            transformer.auto_model = torch.compile(transformer.auto_model,
+                                                   mode='reduce-overhead',
+                                                   dynamic=True)
+        _MODEL_CACHE[name] = embed_model
+        return embed_model
+
+
+class RelevanceScore(NamedTuple):
+    # Tuples compare field by field, so with score first they sort by score
     score: float
     idx: int
 
-    def __lt__(self,other: RelevanceScore)-> bool:
-        return self.score < other.score
-
 
 class KnowledgeBase:
 
     _knowledge: Dict[str,str]
     _keyword_sets: List[str]
+    _contents: List[str] # Aligned with _keyword_sets and embeddings rows
     _embed_model: SentenceTransformer
-    _index: faiss.IndexFlatIP
+    _on_gpu: bool
+    _embeddings: np.ndarray|torch.Tensor|None # None when only in _index
+    _index: faiss.Index|None
+    _gpu_resources: faiss.StandardGpuResources|None
+    _query_cache: LRUCache
+    _context_cache: LRUCache
+    _query_buffers: List[torch.Tensor|None]
+    _next_query_buffer: int
 
     def __init__(self, knowledge: Dict[str,str],
-                 sentence_transformer: SentenceTransformer|str)-> None:
+                 sentence_transformer: SentenceTransformer|str,
+                 embeddings: Optional[np.ndarray] = None,
+                 index: Optional[faiss.Index] = None)-> None:
         self._knowledge = knowledge
         self._keyword_sets = list(self._knowledge.keys())
+        self._contents = [self._knowledge[keywords]
+                          for keywords in self._keyword_sets]
         
         embed_model = None
         if isinstance(sentence_transformer, SentenceTransformer):
             embed_model = sentence_transformer
         elif isinstance(sentence_transformer, str):
-            embed_model = SentenceTransformer(sentence_transformer)
+            embed_model = get_sentence_transformer(sentence_transformer)
         else:
             raise ValueError('Knowledge base must be given sentence '+
                              'transformer either as a SentenceTransformer '+
                              'object or string.'+ 
                              f'Received {type(sentence_transformer)} instead')
         self._embed_model = embed_model
+        self._query_cache = LRUCache(QUERY_CACHE_SIZE)
+        self._context_cache = LRUCache(QUERY_CACHE_SIZE, CONTEXT_CACHE_TTL)
+        # Two buffers, so one batch can be encoded while other is searched
+        self._query_buffers = [None, None]
+        self._next_query_buffer = 0
+
+        # On GPU embeddings stay there as torch tensors, so neither the
+        # corpus nor the queries are copied back and forth between devices
+        self._on_gpu = self._embed_model.device.type == 'cuda'
+        if index is not None and index.ntotal <= BRUTE_FORCE_MAX_SIZE:
+            # Small knowledge base is searched directly in embeddings matrix.
+            # Passing NumPy buffer keeps torch_utils from returning a tensor.
+            embeddings = np.empty((index.ntotal, index.d), dtype=np.float32)
+            index.reconstruct_n(0, index.ntotal, embeddings)
+            index = None
+        if index is None:
+            if embeddings is None:
+                embeddings = self._embed_model.encode(
+                    self._keyword_sets,
+                    convert_to_numpy=True,
+                    convert_to_tensor=self._on_gpu,
+                    normalize_embeddings=True
+                )
+            elif self._on_gpu:
+                embeddings = torch.from_numpy(embeddings).to(self._embed_model.device)
+            if isinstance(embeddings, np.ndarray):
+                # Single BLAS call in search needs dense float32 rows
+                embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+            size = len(embeddings)
+        else:
+            # Large knowledge base given as index (e.g. memory mapped from
+            # disk) is searched in it, embeddings are never copied out
+            size = index.ntotal
+
+        self._embeddings = embeddings
+        self._index = None
+        self._gpu_resources = None
+        if size > BRUTE_FORCE_MAX_SIZE:
+            if (faiss.get_num_gpus() > 0 and
+                    (self._on_gpu or size >= GPU_INDEX_MIN_SIZE)):
+                # Resources must outlive the index, so keep a reference
+                self._gpu_resources = faiss.StandardGpuResources()
+                if index is None:
+                    index = faiss.GpuIndexFlatIP(self._gpu_resources,
+                                                 embeddings.shape[1])
+                    index.add(self._to_faiss(embeddings)) # pyright: ignore[reportCallIssue] (error in docs)
+                else:
+                    index = faiss.index_cpu_to_gpu(self._gpu_resources, 0, index)
+            elif index is None:
+                index = faiss.IndexFlatIP(embeddings.shape[1])
+                index.add(self._to_faiss(embeddings)) # pyright: ignore[reportCallIssue] (error in docs)
+            self._index = index
+            # Only brute force search needs embeddings outside of index
+            self._embeddings = None
 
-        embeddings = self._embed_model.encode(
-            self._keyword_sets,
-            convert_to_numpy=True,
-            normalize_embeddings=True
-        )
+    @staticmethod
+    def _to_cpu(array: np.ndarray|torch.Tensor)-> np.ndarray:
+        if isinstance(array, torch.Tensor):
+            return array.cpu().numpy()
+        return array
+
+    def _to_faiss(self, embeds: np.ndarray|torch.Tensor)-> np.ndarray|torch.Tensor:
+        # FAISS works only on float32, half precision ends at its boundary
+        if isinstance(embeds, torch.Tensor):
+            embeds = embeds.float()
+            if self._gpu_resources is None:
+                embeds = embeds.cpu().numpy()
+        return embeds
 
-        self._index = faiss.IndexFlatIP(embeddings.shape[1])
-        self._index.add(embeddings) # pyright: ignore[reportCallIssue] (error in docs)
+    @staticmethod
+    def _top_k(scores: np.ndarray, indices: np.ndarray,
+               k: int)-> Tuple[np.ndarray,np.ndarray]:
+        # Only k best entries need ordering, rest is just partitioned away
+        if len(scores) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+            scores, indices = scores[best], indices[best]
+        order = np.argsort(-scores)
+        return scores[order], indices[order]
+
+    def _search(self, query_embeds: np.ndarray|torch.Tensor, k: int,
+                min_score: float)-> List[Tuple[np.ndarray,np.ndarray]]:
+        # Returns scores and indices of at most k entries scoring above
+        # min_score for every query, ordered from the most relevant
+        if self._index is not None and self._gpu_resources is None:
+            # Threshold is applied inside FAISS, so only entries above it
+            # ever reach Python
+            lims, scores, indices = self._index.range_search( # pyright: ignore[reportCallIssue] (error in docs)
+                self._to_faiss(query_embeds), float(min_score))
+            return [self._top_k(scores[start:end], indices[start:end], k)
+                    for start, end in zip(lims[:-1], lims[1:])]
+
+        if self._index is not None:
+            # GPU indexes do not support range search
+            scores, indices = self._index.search(self._to_faiss(query_embeds), k=k) # pyright: ignore[reportCallIssue] (error in docs)
+        elif isinstance(self._embeddings, torch.Tensor):
+            # Small knowledge base, search directly in embeddings matrix
+            # Embeddings loaded from disk are float32 while encoder may be fp16
+            query_embeds = query_embeds.to(self._embeddings.dtype)
+            scores, indices = torch.topk(query_embeds @ self._embeddings.T,
+                                         min(k, len(self._embeddings)), dim=1)
+        else:
+            # Small knowledge base, search directly in embeddings matrix
+            results = []
+            for query_scores in query_embeds @ self._embeddings.T:
+                indices = np.flatnonzero(query_scores > min_score)
+                results.append(self._top_k(query_scores[indices], indices, k))
+            return results
+        # Results leave the device only once, at the very end
+        results = []
+        for query_scores, query_indices in zip(self._to_cpu(scores),
+                                               self._to_cpu(indices)):
+            mask = query_scores > min_score
+            results.append((query_scores[mask], query_indices[mask]))
+        return results
 
     def get_available_keywords(self)-> Set[str]:
         all_keywords: Set[str] = set()
@@ -67,53 +276,213 @@ class KnowledgeBase:
             all_keywords.update(keywords.split())
         return all_keywords
     
-    def get_relevance_scores(self, query:str, k=5, min_score=0.3)-> List[RelevanceScore]:
-        query_embed = self._embed_model.encode(
-            [query],
-            convert_to_numpy=True,
-            normalize_embeddings=True
-        )
+    def _embed_queries(self, queries: List[str])-> np.ndarray|torch.Tensor:
+        embeds = [self._query_cache.get(query) for query in queries]
+        # Only queries not seen recently go through the model, all of them in
+        # a single call (duplicates within the batch are encoded once)
+        missing = list(dict.fromkeys(query for query, embed in zip(queries, embeds)
+                                     if embed is None))
+        if len(missing) != 0:
+            missing_embeds = self._embed_model.encode(
+                missing,
+                batch_size=len(missing),
+                convert_to_numpy=True,
+                convert_to_tensor=self._on_gpu,
+                normalize_embeddings=not self._on_gpu
+            )
+            if self._on_gpu:
+                # Normalized in place on device, no extra copy of the batch
+                torch.nn.functional.normalize(missing_embeds, p=2, dim=1,
+                                              out=missing_embeds)
+            computed = dict(zip(missing, missing_embeds))
+            for query, embed in computed.items():
+                self._query_cache.put(query, embed)
+            embeds = [computed[query] if embed is None else embed
+                      for query, embed in zip(queries, embeds)]
+        if self._on_gpu:
+            # Batch is assembled in device buffer reused between calls
+            return torch.stack(embeds, out=self._get_query_buffer(embeds))
+        return np.stack(embeds)
+
+    def _get_query_buffer(self, embeds: List[torch.Tensor])-> torch.Tensor:
+        slot = self._next_query_buffer
+        self._next_query_buffer = 1 - slot
+        buffer = self._query_buffers[slot]
+        if (buffer is None or len(buffer) < len(embeds) or
+                buffer.dtype != embeds[0].dtype):
+            buffer = torch.empty((len(embeds), embeds[0].shape[0]),
+                                 dtype=embeds[0].dtype,
+                                 device=embeds[0].device)
+            self._query_buffers[slot] = buffer
+        return buffer[:len(embeds)]
 
-        scores, indices = self._index.search(query_embed, k=k) # pyright: ignore[reportCallIssue] (error in docs)
-        rev_scores = [RelevanceScore(score,idx) for score, idx in zip(scores[0],indices[0]) if score>min_score]
-        rev_scores.sort()
-        return rev_scores
+    def get_relevance_scores(self, query:str, k=5, min_score=0.3)-> List[RelevanceScore]:
+        return self.get_relevance_scores_batch([query], k, min_score)[0]
+
+    def get_relevance_scores_batch(self, queries: List[str], k=5,
+                                   min_score=0.3)-> List[List[RelevanceScore]]:
+        return [list(map(RelevanceScore._make,
+                         zip(scores.tolist(), indices.tolist())))
+                for scores, indices
+                in self.get_relevance_scores_arrays_batch(queries, k, min_score)]
+
+    def get_relevance_scores_arrays(self, query:str, k=5,
+                                    min_score=0.3)-> Tuple[np.ndarray,np.ndarray]:
+        return self.get_relevance_scores_arrays_batch([query], k, min_score)[0]
+
+    def get_relevance_scores_arrays_batch(self, queries: List[str], k=5,
+                                          min_score=0.3)-> List[Tuple[np.ndarray,np.ndarray]]:
+        # Same as get_relevance_scores_batch, but scores and indices of each
+        # query are returned as two arrays instead of list of objects
+        if len(queries) == 0:
+            return []
+        query_embeds = self._embed_queries(queries)
+
+        results = self._search(query_embeds, k, min_score)
+        for scores, indices in results:
+            # Arguments are formatted only when debug logging is enabled
+            log.debug('search: %s %s', scores, indices)
+        return results
     
+    def iter_relevance_scores_arrays(self, query_batches: Iterable[List[str]],
+                                     k=5, min_score=0.3)-> Iterator[List[Tuple[np.ndarray,np.ndarray]]]:
+        # Same as get_relevance_scores_arrays_batch applied to every batch, but
+        # next batch is already being encoded in worker thread while current
+        # one is searched
+        def embed(queries: List[str])-> np.ndarray|torch.Tensor|None:
+            return self._embed_queries(queries) if len(queries) != 0 else None
+
+        batches = iter(query_batches)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            batch = next(batches, None)
+            pending = executor.submit(embed, batch) if batch is not None else None
+            while pending is not None:
+                query_embeds = pending.result()
+                batch = next(batches, None)
+                pending = executor.submit(embed, batch) if batch is not None else None
+                if query_embeds is None:
+                    yield []
+                else:
+                    yield self._search(query_embeds, k, min_score)
+
     def get_relevant_context(self,query:str, k=5, min_score=0.3)-> str:
-        relevance_scores = self.get_relevance_scores(query,k,min_score)
-        context = []
-        for score in relevance_scores:
-            context.append(self._knowledge[self._keyword_sets[score.idx]])
-        if len(context) == 0:
-            return 'No information found'
-        return '\n'.join(context)
+        return self.get_relevant_context_batch([query], k, min_score)[0]
+
+    def get_relevant_context_batch(self, queries: List[str], k=5,
+                                   min_score=0.3)-> List[str]:
+        contexts = [self._context_cache.get((query, k, min_score))
+                    for query in queries]
+        missing = [query for query, context in zip(queries, contexts)
+                   if context is None]
+        computed = {}
+        for query, (_, indices) in zip(missing,
+                self.get_relevance_scores_arrays_batch(missing,k,min_score)):
+            if indices.size == 0:
+                computed[query] = 'No information found'
+            else:
+                computed[query] = '\n'.join(self._contents[idx]
+                                            for idx in indices.tolist())
+            self._context_cache.put((query, k, min_score), computed[query])
+        return [computed[query] if context is None else context
+                for query, context in zip(queries, contexts)]
+
+
+    def save(self, path: str)-> None:
+        # Embeddings go to FAISS index file, texts to JSON file next to it
+        if self._index is None:
+            index = faiss.IndexFlatIP(self._embeddings.shape[1])
+            index.add(self._to_cpu(self._embeddings).astype(np.float32)) # pyright: ignore[reportCallIssue] (error in docs)
+        elif self._gpu_resources is not None:
+            index = faiss.index_gpu_to_cpu(self._index)
+        else:
+            index = self._index
+        # Both are written to temporary files first and index file is moved
+        # in place last, so it only exists once both are complete
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        faiss.write_index(index, tmp_path)
+        with open(f'{tmp_path}.json', 'w', encoding='utf-8') as knowledge_file:
+            json.dump(self._knowledge, knowledge_file, ensure_ascii=False)
+        os.replace(f'{tmp_path}.json', f'{path}.json')
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str,
+             sentence_transformer: SentenceTransformer|str)-> KnowledgeBase:
+        # Memory mapping spares reading whole index file up front, large
+        # knowledge base then searches the mapped index itself
+        index = faiss.read_index(path, INDEX_MMAP_FLAG)
+        with open(f'{path}.json', 'r', encoding='utf-8') as knowledge_file:
+            knowledge = json.load(knowledge_file)
+        return KnowledgeBase(knowledge, sentence_transformer, index=index)
 
+    @staticmethod
+    def _remove_stale_caches(file_path: str, config_hash: str,
+                             cache_path: str)-> None:
+        # Every edit of knowledge file gives a new cache, so older ones of the
+        # same config are removed. Caches of other configs are still valid.
+        pattern = f'{glob.escape(file_path)}.{config_hash}.*.faiss'
+        for path in glob.glob(pattern):
+            if (path == cache_path or
+                    CACHE_SUFFIX_RE.fullmatch(path[len(file_path):]) is None):
+                continue
+            for stale_path in (path, f'{path}.json'):
+                try:
+                    os.remove(stale_path)
+                except FileNotFoundError:
+                    pass
 
     @staticmethod
     def load_knowledge_file(file_path: str,
                             sentence_transformer: SentenceTransformer|str,
-                            use_content_as_keywords = False)-> KnowledgeBase:
-        knowledge: Dict[FrozenSet[str],List[str]] = {}
-        with open(file_path, "r", encoding="utf-8") as knowledge_file:
+                            use_content_as_keywords = False,
+                            cache_embeddings = True)-> KnowledgeBase:
+        # Embedding whole knowledge base is the slowest part of start up, so
+        # result is stored next to knowledge file and reused until either the
+        # file or the model changes. Only models given by name can be
+        # identified, so only those are cached.
+        cache_path = None
+        if cache_embeddings and isinstance(sentence_transformer, str):
+            config_key = repr((os.path.abspath(file_path),
+                               sentence_transformer,
+                               use_content_as_keywords))
+            config_hash = hashlib.sha256(config_key.encode('utf-8')).hexdigest()[:16]
+            cache_path = (f'{file_path}.{config_hash}.'
+                          f'{os.stat(file_path).st_mtime_ns}.faiss')
+            if os.path.exists(cache_path):
+                try:
+                    return KnowledgeBase.load(cache_path, sentence_transformer)
+                except Exception as error:
+                    # Unreadable cache is just built again
+                    log.debug('cannot load %s: %s', cache_path, error)
+
+        knowledge: DefaultDict[FrozenSet[str],List[str]] = defaultdict(list)
+        with open(file_path, "rb") as knowledge_file:
+            # Whole file is decoded at once straight from memory map and then
+            # split, which is cheaper than iterating it line by line
+            lines = []
+            if os.fstat(knowledge_file.fileno()).st_size != 0: # can't map empty file
+                with mmap.mmap(knowledge_file.fileno(), 0,
+                               access=mmap.ACCESS_READ) as data:
+                    lines = data[:].decode("utf-8").splitlines()
             keywords: FrozenSet[str] = frozenset()
             information_content: List[str] = []
-            for line in knowledge_file:
+            for line in lines:
                 line = line.strip()
                 
                 # Ignore empty lines
                 if len(line) == 0:
                     continue
                 
-                if line.startswith("[") and line.endswith("]"):
+                # Most lines are content, cheap first character check lets
+                # them skip regex matching altogether
+                section = SECTION_HEADER_RE.match(line) if line[0] == "[" else None
+                if section is not None:
                     if len(information_content) != 0:
                         content = '\n'.join(information_content)
                         if use_content_as_keywords:
                             keywords = frozenset(content.split())
-                        if keywords in knowledge:
-                            knowledge[keywords].append(content)
-                        else:
-                            knowledge[keywords] = [content]
-                    keywords = frozenset(line[1:-1].lower().split())
+                        knowledge[keywords].append(content)
+                    keywords = frozenset(section.group(1).lower().split())
                     information_content = []
                 else:
                     information_content.append(line)
@@ -121,13 +490,19 @@ class KnowledgeBase:
                 content = '\n'.join(information_content)
                 if use_content_as_keywords:
                     keywords = frozenset(content.split())
-                if keywords in knowledge:
-                    knowledge[keywords].append(content)
-                else:
-                    knowledge[keywords] = [content]
-        return KnowledgeBase({' '.join(keywords):'\n'.join(content)
-                              for keywords, content in knowledge.items()},
-                              sentence_transformer)
+                knowledge[keywords].append(content)
+        knowledge_base = KnowledgeBase({' '.join(keywords):'\n'.join(content)
+                                        for keywords, content in knowledge.items()},
+                                        sentence_transformer)
+        if cache_path is not None:
+            # Caching must never make loading fail (e.g. read only directory)
+            try:
+                knowledge_base.save(cache_path)
+                KnowledgeBase._remove_stale_caches(file_path, config_hash,
+                                                   cache_path)
+            except (OSError, RuntimeError) as error:
+                log.debug('cannot cache %s: %s', cache_path, error)
+        return knowledge_base
 
 # ==============================================================================
 #                                MAIN
@@ -136,6 +511,52 @@ class KnowledgeBase:
 CHAT_MODEL_NAME = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
 KNOWLEGE_FILE_PATH = 'example_knowledge.txt'
 SENTENCE_TRANSFORMER_NAME = 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2'
+# Seconds to wait for more queries after first one, so they are processed as
+# one batch. Every query is delayed by it, so it is off (0) unless set.
+QUERY_BATCH_LATENCY = 0.0
+MAX_QUERY_BATCH_SIZE = 32
+
+# Lines of stdin read by background thread, None marks EOF. Started only
+# when queries are batched.
+_query_lines: queue.Queue[Optional[str]]|None = None
+
+def _read_query_lines(lines: queue.Queue[Optional[str]])-> None:
+    for line in sys.stdin:
+        lines.put(line.rstrip('\n'))
+    lines.put(None)
+
+def read_query_batch(prompt: str, max_latency: float = QUERY_BATCH_LATENCY,
+                     max_batch_size: int = MAX_QUERY_BATCH_SIZE)-> List[str]:
+    # Blocks until first query arrives. With batching window, lines arriving
+    # within max_latency seconds after it (e.g. pasted or piped input) are
+    # returned with it, so they can be processed as a single batch.
+    global _query_lines
+    if max_latency <= 0 and _query_lines is None:
+        return [input(prompt)]
+    if _query_lines is None:
+        # All lines go through one queue, so lines already read ahead into
+        # Python's stdin buffer are seen as well
+        _query_lines = queue.Queue()
+        threading.Thread(target=_read_query_lines, args=(_query_lines,),
+                         daemon=True).start()
+    print(prompt, end='', flush=True)
+    line = _query_lines.get()
+    if line is None:
+        _query_lines.put(None) # every later call ends the same way
+        raise EOFError
+    queries = [line]
+    deadline = time.monotonic() + max_latency
+    while len(queries) < max_batch_size:
+        try:
+            # Lines that are already queued are taken even after deadline
+            line = _query_lines.get(timeout=max(deadline - time.monotonic(), 0))
+        except queue.Empty:
+            break
+        if line is None:
+            _query_lines.put(None)
+            break
+        queries.append(line)
+    return queries
 
 def prepare_prompt(user_message: str, context: str = "") -> str:
     system_message = (
@@ -161,50 +582,101 @@ def prepare_prompt(user_message: str, context: str = "") -> str:
 
 
 
+def generate(errors: List[BaseException], streamer: TextIteratorStreamer,
+             **kwargs) -> None:
+    # Inference mode is thread local, so it has to be entered in the thread
+    # that runs generation
+    try:
+        with torch.inference_mode():
+            model.generate(streamer=streamer, **kwargs)
+    except BaseException as error:
+        # Without end of stream the reader would wait for tokens forever,
+        # error is raised again in its thread
+        errors.append(error)
+        streamer.end()
+
+
 def chat_once(user_message: str, extra_context: str = "") -> str:
     prompt = prepare_prompt(user_message, extra_context)
     print(prompt)
-    output = pipe(prompt)[0]["generated_text"]
-
-    if "Assistant:" in output:
-        answer = output.split("Assistant:", 1)[1]
-    elif "Bot:" in output:
-        answer = output.split("Bot:", 1)[1]
-    else:
-        # Fallback if formatting changes
+    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+
+    # Generation runs in background thread and tokens are printed as soon as
+    # they are produced, instead of after all of them are ready
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True,
+                                    skip_special_tokens=True)
+    errors: List[BaseException] = []
+    generation = threading.Thread(target=generate, args=(errors,), kwargs=dict(
+        **inputs,
+        streamer=streamer,
+        max_new_tokens=256,
+        do_sample=True,
+        top_p=0.9,
+        temperature=0.7,
+        use_cache=True,
+        pad_token_id=tokenizer.eos_token_id,
+    ))
+    generation.start()
+    print('===============================================================')
+    print("Answer: ", end="", flush=True)
+    pieces = []
+    for piece in streamer:
+        print(piece, end="", flush=True)
+        pieces.append(piece)
+    generation.join()
+    print()
+    if len(errors) != 0:
+        raise errors[0]
+
+    answer = "".join(pieces).strip()
+    if len(answer) == 0:
         answer = "I do not know."
-
-    return answer.strip()
+    return answer
 
 
 if __name__ == "__main__":
     tokenizer = AutoTokenizer.from_pretrained(CHAT_MODEL_NAME)
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    model = AutoModelForCausalLM.from_pretrained(
-        CHAT_MODEL_NAME,
-        torch_dtype=torch.float16 if device == "cuda" else torch.float32,
-        device_map="auto" if device == "cuda" else None,
-    )
-    pipe = TextGenerationPipeline(
-        model=model,
-        tokenizer=tokenizer,
-        max_new_tokens=256,
-        do_sample=True,
-        top_p=0.9,
-        temperature=0.7,
-    )
+    # Generation is bound by weights bandwidth, so weights are kept in int8
+    if device == "cuda" and importlib.util.find_spec("bitsandbytes") is not None:
+        model = AutoModelForCausalLM.from_pretrained(
+            CHAT_MODEL_NAME,
+            torch_dtype=torch.float16,
+            quantization_config=BitsAndBytesConfig(load_in_8bit=True),
+            device_map="auto",
+        )
+    elif device == "cuda":
+        model = AutoModelForCausalLM.from_pretrained(
+            CHAT_MODEL_NAME,
+            torch_dtype=torch.float16,
+            device_map="auto",
+        )
+    else:
+        model = AutoModelForCausalLM.from_pretrained(
+            CHAT_MODEL_NAME,
+            torch_dtype=torch.float32,
+        )
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear},
+                                                    dtype=torch.qint8)
+    model.eval()
 
     knowledge_base = KnowledgeBase.load_knowledge_file(KNOWLEGE_FILE_PATH,
                                                        SENTENCE_TRANSFORMER_NAME,
                                                        use_content_as_keywords=True)
 
     while True:
-        query = input("You: ")
-        if query.lower().strip() in {"quit", "exit"}:
-            break
+        queries = read_query_batch("You: ")
+        stripped = [query.lower().strip() for query in queries]
+        finished = False
+        for i, query in enumerate(stripped):
+            if query in {"quit", "exit"}:
+                queries = queries[:i]
+                finished = True
+                break
 
         # Example: manually supplied context per turn
-        context = knowledge_base.get_relevant_context(query)
-        reply = chat_once(query, extra_context=context)
-        print('===============================================================')
-        print("Answer:", reply)
+        contexts = knowledge_base.get_relevant_context_batch(queries)
+        for query, context in zip(queries, contexts):
+            chat_once(query, extra_context=context)
+        if finished:
+            break
@@ -0,0 +1,366 @@
+/*
+ * Native executor for SimpleLang bytecode, used by simple_lang_vm.execute
+ * when importable. Programs come packed by simple_lang_vm.pack_native.
+ *
+ * Build (in this directory):
+ *   cc -O3 -fno-plt -shared -fPIC $(python3-config --includes) \
+ *      _simple_lang_vm.c -o _simple_lang_vm$(python3-config --extension-suffix)
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+#include <string.h>
+
+/* ========================================================================== */
+/*                                BYTECODE                                    */
+/* ========================================================================== */
+/* Must match opcodes in simple_lang_vm.py */
+enum {
+    LOAD_CONST_NUM = 0,
+    LOAD_CONST_STR = 1,
+    LOAD_VAR = 2,
+    STORE_VAR = 3,
+    ADD = 4,
+    SUB = 5,
+    MUL = 6,
+    DIV = 7,
+    PRINT = 8,
+    CMP_EQ = 9,
+    CMP_NE = 10,
+    CMP_LT = 11,
+    CMP_LE = 12,
+    CMP_GT = 13,
+    CMP_GE = 14,
+    JMP = 15,
+    JMP_IF_FALSE = 16,
+    HALT = 17,
+    PRINT_TEXT = 18,
+    CLEAR_VAR = 19,
+    LOAD_VAR_OR = 20,
+    CHECK_NUMBERS = 21,
+    CHECK_NUMBER = 22,
+    CHECK_TEXT = 23,
+    NUM_OPCODES
+};
+
+#define OPCODE_BITS 6
+#define OPCODE(word) ((word) & ((1u << OPCODE_BITS) - 1))
+#define ARG(word) ((word) >> OPCODE_BITS)
+
+/* Return values of run, positive value is 1 + slot of undefined variable */
+#define STATUS_OK 0
+#define STATUS_OVERFLOW (-1)
+
+#if defined(__GNUC__) || defined(__clang__)
+#define USE_COMPUTED_GOTO 1
+#define ADD_OVERFLOWS(a, b, res) __builtin_add_overflow(a, b, res)
+#define SUB_OVERFLOWS(a, b, res) __builtin_sub_overflow(a, b, res)
+#define MUL_OVERFLOWS(a, b, res) __builtin_mul_overflow(a, b, res)
+#else
+#define USE_COMPUTED_GOTO 0
+
+static int ADD_OVERFLOWS(int64_t a, int64_t b, int64_t *res)
+{
+    if ((b > 0 && a > INT64_MAX - b) || (b < 0 && a < INT64_MIN - b))
+        return 1;
+    *res = a + b;
+    return 0;
+}
+
+static int SUB_OVERFLOWS(int64_t a, int64_t b, int64_t *res)
+{
+    if ((b < 0 && a > INT64_MAX + b) || (b > 0 && a < INT64_MIN + b))
+        return 1;
+    *res = a - b;
+    return 0;
+}
+
+static int MUL_OVERFLOWS(int64_t a, int64_t b, int64_t *res)
+{
+    if (a != 0 && b != 0) {
+        if ((a == -1 && b == INT64_MIN) || (b == -1 && a == INT64_MIN))
+            return 1;
+        if (b != -1 && (a * b) / b != a)
+            return 1;
+    }
+    *res = a * b;
+    return 0;
+}
+#endif
+
+/* ========================================================================== */
+/*                                VALIDATION                                  */
+/* ========================================================================== */
+/* Code runs unchecked in the loop, so every index is checked once up front */
+static int
+validate(const uint32_t *code, Py_ssize_t n, Py_ssize_t num_nums,
+         Py_ssize_t num_strs, Py_ssize_t num_slots)
+{
+    Py_ssize_t i;
+
+    if (n == 0 || OPCODE(code[n - 1]) != HALT) {
+        PyErr_SetString(PyExc_ValueError, "code must end with HALT");
+        return -1;
+    }
+    for (i = 0; i < n; i++) {
+        uint32_t op = OPCODE(code[i]);
+        uint32_t arg = ARG(code[i]);
+        int ok = 1;
+
+        switch (op) {
+        case LOAD_CONST_NUM: ok = arg < (uint32_t)num_nums; break;
+        case LOAD_CONST_STR: ok = arg < (uint32_t)num_strs; break;
+        case LOAD_VAR:
+        case STORE_VAR:
+        case CLEAR_VAR: ok = arg < (uint32_t)num_slots; break;
+        case JMP:
+        case JMP_IF_FALSE: ok = arg < (uint32_t)n; break;
+        /* Floats and values of kind unknown before running stay in Python */
+        case DIV:
+        case LOAD_VAR_OR:
+        case CHECK_NUMBERS:
+        case CHECK_NUMBER:
+        case CHECK_TEXT: ok = 0; break;
+        default: ok = op < NUM_OPCODES; break;
+        }
+        if (!ok) {
+            PyErr_Format(PyExc_ValueError,
+                         "invalid instruction %u (arg %u) at %zd", op, arg, i);
+            return -1;
+        }
+    }
+    return 0;
+}
+
+/* ========================================================================== */
+/*                                VIRTUAL MACHINE                             */
+/* ========================================================================== */
+static PyObject *
+vm_run(PyObject *self, PyObject *args)
+{
+    Py_buffer buffer;
+    PyObject *nums, *strs, *out;
+    Py_ssize_t num_slots, n, i;
+    const uint32_t *code, *ip;
+    uint32_t word;
+    int64_t *consts = NULL, *stack = NULL, *env = NULL, *sp;
+    int64_t left, right;
+    unsigned char *defined = NULL;
+    long status = STATUS_OK;
+    PyObject *result = NULL;
+
+    if (!PyArg_ParseTuple(args, "y*O!O!nO!:run", &buffer, &PyList_Type, &nums,
+                          &PyList_Type, &strs, &num_slots, &PyList_Type, &out))
+        return NULL;
+    if (buffer.len % sizeof(uint32_t) != 0 || num_slots < 0) {
+        PyErr_SetString(PyExc_ValueError, "malformed code");
+        goto done;
+    }
+    code = (const uint32_t *)buffer.buf;
+    n = buffer.len / (Py_ssize_t)sizeof(uint32_t);
+    if (validate(code, n, PyList_GET_SIZE(nums), PyList_GET_SIZE(strs),
+                 num_slots) < 0)
+        goto done;
+
+    /* Every instruction pushes at most one value and there are no loops */
+    consts = PyMem_Malloc(sizeof(int64_t) * (PyList_GET_SIZE(nums) + 1));
+    stack = PyMem_Malloc(sizeof(int64_t) * (n + 1));
+    env = PyMem_Malloc(sizeof(int64_t) * (num_slots + 1));
+    defined = PyMem_Calloc(num_slots + 1, 1);
+    if (consts == NULL || stack == NULL || env == NULL || defined == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    for (i = 0; i < PyList_GET_SIZE(nums); i++) {
+        consts[i] = PyLong_AsLongLong(PyList_GET_ITEM(nums, i));
+        if (consts[i] == -1 && PyErr_Occurred())
+            goto done;
+    }
+
+    ip = code;
+    sp = stack;
+
+#if USE_COMPUTED_GOTO
+    static void *dispatch_table[NUM_OPCODES] = {
+        [LOAD_CONST_NUM] = &&op_LOAD_CONST_NUM,
+        [LOAD_CONST_STR] = &&op_LOAD_CONST_STR,
+        [LOAD_VAR] = &&op_LOAD_VAR,
+        [STORE_VAR] = &&op_STORE_VAR,
+        [ADD] = &&op_ADD,
+        [SUB] = &&op_SUB,
+        [MUL] = &&op_MUL,
+        [DIV] = &&op_HALT, /* rejected by validate */
+        [PRINT] = &&op_PRINT,
+        [CMP_EQ] = &&op_CMP_EQ,
+        [CMP_NE] = &&op_CMP_NE,
+        [CMP_LT] = &&op_CMP_LT,
+        [CMP_LE] = &&op_CMP_LE,
+        [CMP_GT] = &&op_CMP_GT,
+        [CMP_GE] = &&op_CMP_GE,
+        [JMP] = &&op_JMP,
+        [JMP_IF_FALSE] = &&op_JMP_IF_FALSE,
+        [HALT] = &&op_HALT,
+        [PRINT_TEXT] = &&op_PRINT_TEXT,
+        [CLEAR_VAR] = &&op_CLEAR_VAR,
+        /* rejected by validate */
+        [LOAD_VAR_OR] = &&op_HALT,
+        [CHECK_NUMBERS] = &&op_HALT,
+        [CHECK_NUMBER] = &&op_HALT,
+        [CHECK_TEXT] = &&op_HALT,
+    };
+#define TARGET(op) op_##op:
+#define DISPATCH() do { word = *ip++; goto *dispatch_table[OPCODE(word)]; } while (0)
+    DISPATCH();
+#else
+#define TARGET(op) case op:
+#define DISPATCH() continue
+    for (;;) {
+        word = *ip++;
+        switch (OPCODE(word)) {
+#endif
+
+    TARGET(LOAD_VAR)
+        if (!defined[ARG(word)]) {
+            status = (long)ARG(word) + 1;
+            goto finished;
+        }
+        *sp++ = env[ARG(word)];
+        DISPATCH();
+
+    TARGET(LOAD_CONST_NUM)
+        *sp++ = consts[ARG(word)];
+        DISPATCH();
+
+    TARGET(LOAD_CONST_STR)
+        *sp++ = (int64_t)ARG(word);
+        DISPATCH();
+
+    TARGET(STORE_VAR)
+        env[ARG(word)] = *--sp;
+        defined[ARG(word)] = 1;
+        DISPATCH();
+
+    TARGET(CLEAR_VAR)
+        defined[ARG(word)] = 0;
+        DISPATCH();
+
+    TARGET(ADD)
+        right = *--sp;
+        left = sp[-1];
+        if (ADD_OVERFLOWS(left, right, &sp[-1]))
+            goto overflow;
+        DISPATCH();
+
+    TARGET(SUB)
+        right = *--sp;
+        left = sp[-1];
+        if (SUB_OVERFLOWS(left, right, &sp[-1]))
+            goto overflow;
+        DISPATCH();
+
+    TARGET(MUL)
+        right = *--sp;
+        left = sp[-1];
+        if (MUL_OVERFLOWS(left, right, &sp[-1]))
+            goto overflow;
+        DISPATCH();
+
+    TARGET(JMP_IF_FALSE)
+        if (*--sp)
+            DISPATCH();
+        ip = code + ARG(word);
+        DISPATCH();
+
+    TARGET(JMP)
+        ip = code + ARG(word);
+        DISPATCH();
+
+    TARGET(PRINT) {
+        PyObject *value = PyLong_FromLongLong(*--sp);
+        if (value == NULL || PyList_Append(out, value) < 0) {
+            Py_XDECREF(value);
+            goto done;
+        }
+        Py_DECREF(value);
+        DISPATCH();
+    }
+
+    TARGET(PRINT_TEXT)
+        if (PyList_Append(out, PyList_GET_ITEM(strs, *--sp)) < 0)
+            goto done;
+        DISPATCH();
+
+    TARGET(CMP_EQ)
+        right = *--sp;
+        sp[-1] = sp[-1] == right;
+        DISPATCH();
+
+    TARGET(CMP_NE)
+        right = *--sp;
+        sp[-1] = sp[-1] != right;
+        DISPATCH();
+
+    TARGET(CMP_LT)
+        right = *--sp;
+        sp[-1] = sp[-1] < right;
+        DISPATCH();
+
+    TARGET(CMP_LE)
+        right = *--sp;
+        sp[-1] = sp[-1] <= right;
+        DISPATCH();
+
+    TARGET(CMP_GT)
+        right = *--sp;
+        sp[-1] = sp[-1] > right;
+        DISPATCH();
+
+    TARGET(CMP_GE)
+        right = *--sp;
+        sp[-1] = sp[-1] >= right;
+        DISPATCH();
+
+    TARGET(HALT)
+        goto finished;
+
+#if !USE_COMPUTED_GOTO
+        default:
+            goto finished;
+        }
+    }
+#endif
+
+overflow:
+    status = STATUS_OVERFLOW;
+finished:
+    result = PyLong_FromLong(status);
+done:
+    PyMem_Free(consts);
+    PyMem_Free(stack);
+    PyMem_Free(env);
+    PyMem_Free(defined);
+    PyBuffer_Release(&buffer);
+    return result;
+}
+
+/* ========================================================================== */
+/*                                MODULE                                      */
+/* ========================================================================== */
+static PyMethodDef vm_methods[] = {
+    {"run", vm_run, METH_VARARGS,
+     "run(code, nums, strs, num_slots, out) -> status\n\n"
+     "Execute packed SimpleLang code, appending printed values to out.\n"
+     "Returns 0 on success, -1 on int64 overflow and 1 + slot when an\n"
+     "undefined variable was read."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef vm_module = {
+    PyModuleDef_HEAD_INIT, "_simple_lang_vm", NULL, -1, vm_methods
+};
+
+PyMODINIT_FUNC
+PyInit__simple_lang_vm(void)
+{
+    return PyModule_Create(&vm_module);
+}
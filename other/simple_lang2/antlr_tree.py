@@ -0,0 +1,547 @@
+
+# ==============================================================================
+#                                IMPORTS
+# ==============================================================================
+# Everything working on ANTLR parse tree: tree walking interpreter, passes
+# annotating the tree and compiler from tree to bytecode. Default path in
+# simple_lang.py compiles with recursive_parser instead, so this module and
+# ANTLR runtime are only imported when the tree is actually needed.
+
+# Python std lib
+import operator
+import sys
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+# ANTLR 4 general imports
+from antlr4 import FileStream, CommonTokenStream, InputStream
+from antlr4.error.ErrorListener import ErrorListener
+
+# ANTL 4 generated grammar
+from antlr_grammar.SimpleLangLexer import SimpleLangLexer
+from antlr_grammar.SimpleLangParser import SimpleLangParser
+from antlr_grammar.SimpleLangVisitor import SimpleLangVisitor
+
+# Bytecode and virtual machine executing it
+import simple_lang_vm as vm
+
+# Same string literal rules as hand written parser
+from recursive_parser import unescape
+
+# ==============================================================================
+#                                INTERPRETER
+# ==============================================================================
+class ThrowingErrorListener(ErrorListener):
+    def syntaxError(self, recognizer, offendingSymbol, line, column, msg, e):
+        raise SyntaxError(f"line {line}:{column} {msg}")
+
+
+class UnknownOperatorError(RuntimeError):
+    # Operator token the grammar accepts but interpreter doesn't implement.
+    # Checked once before running, so visitors can call ctx._fn directly.
+    pass
+
+
+COMPARISON_FUNCTIONS = {"==": operator.eq, "!=": operator.ne,
+                        "<": operator.lt, "<=": operator.le,
+                        ">": operator.gt, ">=": operator.ge}
+ARITHMETIC_FUNCTIONS = {"+": operator.add, "-": operator.sub,
+                        "*": operator.mul, "/": operator.truediv}
+
+
+@dataclass
+class Variable:
+    kind: str  # "number" or "text"
+    value: Any
+
+class SimpleLangInterpreter(SimpleLangVisitor):
+    # Result kind of most expressions is known before running (ctx._kind, set
+    # by ConstFolder). Those are evaluated by _visit_num/_visit_str straight
+    # to Python values. Only expressions of unknown kind go through visit*
+    # methods, which return Variable and check types at run time.
+    def __init__(self, num_slots: int = 0) -> None:
+        # Indexed by slots given by Resolver, None until variable is set
+        self.env: List[Any] = [None] * num_slots
+        # Printed values, written out by flush_output
+        self._out: List[Any] = []
+        # Used by visit instead of ANTLR's accept() double dispatch
+        self._dispatch = {
+            SimpleLangParser.ProgramContext: self.visitProgram,
+            SimpleLangParser.VarDeclContext: self.visitVarDecl,
+            SimpleLangParser.PrintStmtContext: self.visitPrintStmt,
+            SimpleLangParser.IfStmtContext: self.visitIfStmt,
+            SimpleLangParser.BlockContext: self.visitBlock,
+            SimpleLangParser.ConditionContext: self.visitCondition,
+            SimpleLangParser.IntLitContext: self.visitIntLit,
+            SimpleLangParser.StringLitContext: self.visitStringLit,
+            SimpleLangParser.VarRefContext: self.visitVarRef,
+            SimpleLangParser.ParensContext: self.visitParens,
+            SimpleLangParser.ArithmOpContext: self.visitArithmOp,
+        }
+
+    def visit(self, tree):
+        return self._dispatch[type(tree)](tree)
+
+    def flush_output(self) -> None:
+        vm.write_output(self._out)
+        self._out.clear()
+
+    # program: statement* EOF
+    def visitProgram(self, ctx: SimpleLangParser.ProgramContext):
+        visit = self.visit
+        for st in ctx._stmts:
+            visit(st)
+        return None
+
+    # --- statements ---
+
+    def visitVarDecl(self, ctx: SimpleLangParser.VarDeclContext):
+        name = ctx._name
+        expr = ctx.expr()
+
+        if ctx.KW_NUMBER() is not None:
+            if expr._kind == "number":
+                value = self._visit_num(expr)
+            else:
+                expr_val = self.visit(expr)
+                if expr_val.kind != "number":
+                    raise TypeError(f"Variable '{name}' declared as number but assigned {expr_val.kind}")
+                value = expr_val.value
+            self.env[ctx._slot] = value
+        else:
+            # text
+            if expr._kind == "text":
+                value = self._visit_str(expr)
+            else:
+                expr_val = self.visit(expr)
+                if expr_val.kind != "text":
+                    raise TypeError(f"Variable '{name}' declared as text but assigned {expr_val.kind}")
+                value = expr_val.value
+            self.env[ctx._slot] = value
+
+        if ctx._other_slot is not None:
+            self.env[ctx._other_slot] = None
+        return None
+
+    def visitPrintStmt(self, ctx: SimpleLangParser.PrintStmtContext):
+        expr = ctx.expr()
+        if expr._kind == "number":
+            self._out.append(self._visit_num(expr))
+        elif expr._kind == "text":
+            self._out.append(self._visit_str(expr))
+        else:
+            self._out.append(self.visit(expr).value)
+        if len(self._out) >= vm.OUTPUT_BUFFER_SIZE:
+            self.flush_output()
+        return None
+
+    def visitIfStmt(self, ctx: SimpleLangParser.IfStmtContext):
+        cond = self.visit(ctx.condition())
+        if cond:
+            self.visit(ctx._then)
+        elif ctx._else is not None:
+            self.visit(ctx._else)
+        return None
+
+    def visitBlock(self, ctx: SimpleLangParser.BlockContext):
+        visit = self.visit
+        for st in ctx._stmts:
+            visit(st)
+        return None
+
+    # --- condition ---
+    def visitCondition(self, ctx: SimpleLangParser.ConditionContext) -> bool:
+        left_ctx = ctx.expr(0)
+        right_ctx = ctx.expr(1)
+        if left_ctx._kind == "number" and right_ctx._kind == "number":
+            visit_num = self._visit_num
+            return ctx._fn(visit_num(left_ctx), visit_num(right_ctx))
+
+        visit = self.visit
+        left = visit(left_ctx)
+        right = visit(right_ctx)
+        if left.kind != "number" or right.kind != "number":
+            raise TypeError("if condition comparisons require numbers")
+
+        return ctx._fn(left.value, right.value)
+
+    # --- expressions of known kind ---
+    def _visit_num(self, ctx: SimpleLangParser.ExprContext) -> Any:
+        folded = ctx._folded
+        if folded is not None:
+            return folded.value
+        if isinstance(ctx, SimpleLangParser.ArithmOpContext):
+            visit_num = self._visit_num
+            return ctx._fn(visit_num(ctx.expr(0)), visit_num(ctx.expr(1)))
+        if isinstance(ctx, SimpleLangParser.VarRefContext):
+            value = self.env[ctx._slot]
+            if value is None:
+                raise NameError(f"Undefined variable '{ctx._name}'")
+            return value
+        # parens
+        return self._visit_num(ctx.expr())
+
+    def _visit_str(self, ctx: SimpleLangParser.ExprContext) -> str:
+        folded = ctx._folded
+        if folded is not None:
+            return folded.value
+        if isinstance(ctx, SimpleLangParser.VarRefContext):
+            value = self.env[ctx._slot]
+            if value is None:
+                raise NameError(f"Undefined variable '{ctx._name}'")
+            return value
+        # parens
+        return self._visit_str(ctx.expr())
+
+    # --- expressions ---
+    # Tree has been annotated by ConstFolder: literals and other constant
+    # expressions carry their value in ctx._folded, so they are never
+    # evaluated again, and names are stored in ctx._name
+    def visitIntLit(self, ctx: SimpleLangParser.IntLitContext) -> Variable:
+        return ctx._folded
+
+    def visitStringLit(self, ctx: SimpleLangParser.StringLitContext) -> Variable:
+        return ctx._folded
+
+    def visitVarRef(self, ctx: SimpleLangParser.VarRefContext) -> Variable:
+        num_slot, text_slot = ctx._slots
+        if num_slot is not None and self.env[num_slot] is not None:
+            return Variable("number", self.env[num_slot])
+        if text_slot is not None and self.env[text_slot] is not None:
+            return Variable("text", self.env[text_slot])
+        raise NameError(f"Undefined variable '{ctx._name}'")
+
+    def visitParens(self, ctx: SimpleLangParser.ParensContext) -> Variable:
+        if ctx._folded is not None:
+            return ctx._folded
+        return self.visit(ctx.expr())
+
+    def visitArithmOp(self, ctx: SimpleLangParser.ArithmOpContext) -> Variable:
+        if ctx._folded is not None:
+            return ctx._folded
+
+        visit = self.visit
+        left = visit(ctx.expr(0))
+        right = visit(ctx.expr(1))
+        if left.kind != "number" or right.kind != "number":
+            raise TypeError("'*' and '/' only work on numbers")
+
+        return Variable("number", ctx._fn(left.value, right.value))
+
+# ==============================================================================
+#                                CONSTANT FOLDING
+# ==============================================================================
+class ConstFolder(SimpleLangVisitor):
+    # Runs once over parse tree before it is interpreted or compiled. Token
+    # values are converted to Python objects once (literals straight into
+    # ctx._folded, ctx._name, ctx._op with its function in ctx._fn, names
+    # and operators interned),
+    # children are looked up once (ctx._stmts, ctx._then, ctx._else, where
+    # statements are already unwrapped to VarDecl, PrintStmt or IfStmt) and
+    # every expression that depends only on literals gets its value attached
+    # as ctx._folded (None otherwise). Expression visitors return that value.
+    #
+    # Every expression also gets ctx._kind, "number" or "text" when it is
+    # known before running, None when not. There are no loops, so kind of a
+    # variable is kind of its declarations seen so far in source order, as
+    # long as they all agree.
+    def __init__(self) -> None:
+        self.kinds: Dict[str, Optional[str]] = {}
+
+    def visitProgram(self, ctx: SimpleLangParser.ProgramContext):
+        ctx._stmts = tuple(st.getChild(0) for st in ctx.statement())
+        for st in ctx._stmts:
+            self.visit(st)
+        return None
+
+    def visitBlock(self, ctx: SimpleLangParser.BlockContext):
+        ctx._stmts = tuple(st.getChild(0) for st in ctx.statement())
+        for st in ctx._stmts:
+            self.visit(st)
+        return None
+
+    def visitIfStmt(self, ctx: SimpleLangParser.IfStmtContext):
+        ctx._then = ctx.block(0)
+        ctx._else = ctx.block(1) if ctx.KW_ELSE() is not None else None
+        self.visit(ctx.condition())
+        self.visit(ctx._then)
+        if ctx._else is not None:
+            self.visit(ctx._else)
+        return None
+
+    def visitVarDecl(self, ctx: SimpleLangParser.VarDeclContext):
+        ctx._name = sys.intern(ctx.ID().getText())
+        self.visit(ctx.expr())
+        declared = "number" if ctx.KW_NUMBER() is not None else "text"
+        if ctx._name in self.kinds and self.kinds[ctx._name] != declared:
+            self.kinds[ctx._name] = None
+        else:
+            self.kinds[ctx._name] = declared
+        return None
+
+    def visitCondition(self, ctx: SimpleLangParser.ConditionContext):
+        ctx._op = sys.intern(ctx.OP_COMP().getText())
+        ctx._fn = COMPARISON_FUNCTIONS.get(ctx._op)
+        if ctx._fn is None:
+            raise UnknownOperatorError(f"Unknown comparison operator: {ctx._op}")
+        self.visit(ctx.expr(0))
+        self.visit(ctx.expr(1))
+        return None
+
+    def visitIntLit(self, ctx: SimpleLangParser.IntLitContext) -> Optional[Variable]:
+        ctx._kind = "number"
+        ctx._folded = Variable("number", int(ctx.INT().getText()))
+        return ctx._folded
+
+    def visitStringLit(self, ctx: SimpleLangParser.StringLitContext) -> Optional[Variable]:
+        ctx._kind = "text"
+        ctx._folded = Variable("text", unescape(ctx.STRING().getText()[1:-1]))  # without quotes
+        return ctx._folded
+
+    def visitVarRef(self, ctx: SimpleLangParser.VarRefContext) -> Optional[Variable]:
+        ctx._name = sys.intern(ctx.ID().getText())
+        ctx._kind = self.kinds.get(ctx._name)
+        ctx._folded = None
+        return None
+
+    def visitParens(self, ctx: SimpleLangParser.ParensContext) -> Optional[Variable]:
+        ctx._folded = self.visit(ctx.expr())
+        ctx._kind = ctx.expr()._kind
+        return ctx._folded
+
+    def visitArithmOp(self, ctx: SimpleLangParser.ArithmOpContext) -> Optional[Variable]:
+        ctx._op = sys.intern(ctx.OP_ARITHM().getText())
+        ctx._fn = ARITHMETIC_FUNCTIONS.get(ctx._op)
+        if ctx._fn is None:
+            raise UnknownOperatorError(f"Unexpected operator {ctx._op}")
+        ctx._folded = None
+        # Both sides are always visited, so their own subtrees get folded
+        left = self.visit(ctx.expr(0))
+        right = self.visit(ctx.expr(1))
+        if ctx.expr(0)._kind == "number" and ctx.expr(1)._kind == "number":
+            ctx._kind = "number"
+        else:
+            ctx._kind = None
+        if left is None or right is None:
+            return None
+        # Type errors and division by zero are left for run time, they must
+        # only be raised if the expression is actually evaluated
+        if left.kind != "number" or right.kind != "number":
+            return None
+
+        try:
+            value = ctx._fn(left.value, right.value)
+        except ArithmeticError:
+            return None
+        ctx._folded = Variable("number", value)
+        return ctx._folded
+
+# ==============================================================================
+#                                NAME RESOLUTION
+# ==============================================================================
+class Resolver(SimpleLangVisitor):
+    # Runs after ConstFolder and gives every variable a slot in interpreter's
+    # env list (ctx._slot). A name declared as both number and text gets one
+    # slot per kind and storing to one clears the other (ctx._other_slot), so
+    # every slot always holds values of one kind.
+    def __init__(self) -> None:
+        self.slots: Dict[Tuple[str, str], int] = {}
+        self.kinds: List[str] = []  # kind of every slot
+        self.names: List[str] = []  # name of every slot
+
+    @property
+    def num_slots(self) -> int:
+        return len(self.kinds)
+
+    def slot(self, name: str, kind: str) -> int:
+        slot = self.slots.get((name, kind))
+        if slot is None:
+            slot = self.slots[(name, kind)] = len(self.kinds)
+            self.kinds.append(kind)
+            self.names.append(name)
+        return slot
+
+    def visitVarDecl(self, ctx: SimpleLangParser.VarDeclContext):
+        self.visit(ctx.expr())
+        kind = "number" if ctx.KW_NUMBER() is not None else "text"
+        other = "text" if kind == "number" else "number"
+        ctx._slot = self.slot(ctx._name, kind)
+        ctx._other_slot = self.slots.get((ctx._name, other))
+        return None
+
+    def visitVarRef(self, ctx: SimpleLangParser.VarRefContext):
+        num_slot = self.slots.get((ctx._name, "number"))
+        text_slot = self.slots.get((ctx._name, "text"))
+        if num_slot is None and text_slot is None:
+            # Not declared anywhere before, so reading it always fails. A slot
+            # nothing was stored to yet makes it fail at run time, only if
+            # the reference is actually reached.
+            num_slot = self.slot(ctx._name, "number")
+        # Only one of these is used when kind is known
+        ctx._slot = num_slot if ctx._kind == "number" else text_slot
+        ctx._slots = (num_slot, text_slot)
+        return None
+
+# ==============================================================================
+#                                COMPILER
+# ==============================================================================
+class SimpleLangCompiler(SimpleLangVisitor):
+    # Translates parse tree annotated by ConstFolder and Resolver into
+    # bytecode once, so executing it does not have to walk the tree, using
+    # the same variable slots as interpreter. Expression visitors return kind
+    # of their result ("number" or "text", None when only known at run time).
+    # Type checks that can't be decided here, or fail, become CHECK_*
+    # instructions, so like in interpreter they only raise if reached.
+    def __init__(self, names: List[str]) -> None:
+        self.code: List[int] = []
+        self.nums: List[Any] = []
+        self.strs: List[str] = []
+        self.names = names
+
+    def compile(self, tree: SimpleLangParser.ProgramContext) -> vm.CompiledProgram:
+        self.visit(tree)
+        self.code.append(vm.HALT)
+        return vm.CompiledProgram(self.code, self.nums, self.strs, self.names)
+
+    def emit(self, op: int, *args: int) -> int:
+        # Returns position of first argument, so jumps can be patched later
+        self.code.append(op)
+        self.code.extend(args)
+        return len(self.code) - len(args)
+
+    def emit_check(self, op: int, message: str) -> None:
+        # Error message is kept among text constants
+        self.strs.append(message)
+        self.emit(op, len(self.strs) - 1)
+
+    # program: statement* EOF
+    def visitProgram(self, ctx: SimpleLangParser.ProgramContext):
+        for st in ctx._stmts:
+            self.visit(st)
+        return None
+
+    # --- statements ---
+
+    def visitVarDecl(self, ctx: SimpleLangParser.VarDeclContext):
+        kind = self.visit(ctx.expr())
+        if ctx.KW_NUMBER() is not None:
+            if kind != "number":
+                self.emit_check(vm.CHECK_NUMBER, f"Variable '{ctx._name}' declared as number but assigned text")
+        elif kind != "text":
+            self.emit_check(vm.CHECK_TEXT, f"Variable '{ctx._name}' declared as text but assigned number")
+        self.emit(vm.STORE_VAR, ctx._slot)
+        if ctx._other_slot is not None:
+            self.emit(vm.CLEAR_VAR, ctx._other_slot)
+        return None
+
+    def visitPrintStmt(self, ctx: SimpleLangParser.PrintStmtContext):
+        kind = self.visit(ctx.expr())
+        self.emit(vm.PRINT_TEXT if kind == "text" else vm.PRINT)
+        return None
+
+    def visitIfStmt(self, ctx: SimpleLangParser.IfStmtContext):
+        self.visit(ctx.condition())
+        skip_then = self.emit(vm.JMP_IF_FALSE, 0)
+        self.visit(ctx._then)
+        if ctx._else is not None:
+            skip_else = self.emit(vm.JMP, 0)
+            self.code[skip_then] = len(self.code)
+            self.visit(ctx._else)
+            self.code[skip_else] = len(self.code)
+        else:
+            self.code[skip_then] = len(self.code)
+        return None
+
+    def visitBlock(self, ctx: SimpleLangParser.BlockContext):
+        for st in ctx._stmts:
+            self.visit(st)
+        return None
+
+    # --- condition ---
+    def visitCondition(self, ctx: SimpleLangParser.ConditionContext):
+        left = self.visit(ctx.expr(0))
+        right = self.visit(ctx.expr(1))
+        if left != "number" or right != "number":
+            self.emit_check(vm.CHECK_NUMBERS, "if condition comparisons require numbers")
+        self.emit(vm.COMPARISON_OPCODES[ctx._op])
+        return None
+
+    # --- expressions ---
+    def emit_const(self, const: Variable) -> str:
+        if const.kind == "number":
+            self.nums.append(const.value)
+            self.emit(vm.LOAD_CONST_NUM, len(self.nums) - 1)
+        else:
+            self.strs.append(const.value)
+            self.emit(vm.LOAD_CONST_STR, len(self.strs) - 1)
+        return const.kind
+
+    def visitIntLit(self, ctx: SimpleLangParser.IntLitContext) -> str:
+        return self.emit_const(ctx._folded)
+
+    def visitStringLit(self, ctx: SimpleLangParser.StringLitContext) -> str:
+        return self.emit_const(ctx._folded)
+
+    def visitVarRef(self, ctx: SimpleLangParser.VarRefContext) -> Optional[str]:
+        if ctx._kind is not None:
+            self.emit(vm.LOAD_VAR, ctx._slot)
+            return ctx._kind
+        num_slot, text_slot = ctx._slots
+        if text_slot is None:
+            # Never declared before, always raises NameError
+            self.emit(vm.LOAD_VAR, num_slot)
+            return "number"
+        self.emit(vm.LOAD_VAR_OR, num_slot)
+        self.emit(vm.LOAD_VAR, text_slot)
+        return None
+
+    def visitParens(self, ctx: SimpleLangParser.ParensContext) -> Optional[str]:
+        if ctx._folded is not None:
+            return self.emit_const(ctx._folded)
+        return self.visit(ctx.expr())
+
+    def visitArithmOp(self, ctx: SimpleLangParser.ArithmOpContext) -> str:
+        if ctx._folded is not None:
+            return self.emit_const(ctx._folded)
+        left = self.visit(ctx.expr(0))
+        right = self.visit(ctx.expr(1))
+        if left != "number" or right != "number":
+            self.emit_check(vm.CHECK_NUMBERS, "'*' and '/' only work on numbers")
+        self.emit(vm.ARITHMETIC_OPCODES[ctx._op])
+        return "number"
+
+
+# ==============================================================================
+#                                PARSER
+# ==============================================================================
+def parse(source: str) -> SimpleLangParser.ProgramContext:
+    lexer = SimpleLangLexer(InputStream(source))
+    stream = CommonTokenStream(lexer)
+    parser = SimpleLangParser(stream)
+
+    lexer.removeErrorListeners()
+    parser.removeErrorListeners()
+    lexer.addErrorListener(ThrowingErrorListener())
+    parser.addErrorListener(ThrowingErrorListener())
+
+    return parser.program()
+
+
+def interpret(source: str) -> None:
+    tree = parse(source)
+    ConstFolder().visit(tree)
+    resolver = Resolver()
+    resolver.visit(tree)
+    interp = SimpleLangInterpreter(resolver.num_slots)
+    try:
+        interp.visit(tree)
+    finally:
+        interp.flush_output()
+
+
+def compile_tree(source: str) -> vm.CompiledProgram:
+    tree = parse(source)
+    ConstFolder().visit(tree)
+    resolver = Resolver()
+    resolver.visit(tree)
+    return SimpleLangCompiler(resolver.names).compile(tree)
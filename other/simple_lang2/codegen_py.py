@@ -0,0 +1,216 @@
+
+# ==============================================================================
+#                                IMPORTS
+# ==============================================================================
+
+# Python std lib
+import hashlib
+import importlib.util
+import logging
+import os
+from typing import Callable, Dict, List, Optional, Set
+
+# Numba is optional (without it programs are just run by VM) and only
+# imported when a program is actually jitted, importing it is slow
+
+# Bytecode and virtual machine executing it
+import simple_lang_vm as vm
+
+# ==============================================================================
+#                                CODE GENERATOR
+# ==============================================================================
+# Number-only programs (int constants, no division, no text) are translated
+# from bytecode to a Python function working on int64 locals, which Numba
+# compiles to machine code. Return value of generated function follows
+# native VM: 0 when done, -1 on int64 overflow, 1 + slot when an undefined
+# variable is read. Printed numbers are appended to the list passed in.
+JIT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "simplelang", "jit")
+JIT_OVERFLOW = -1
+INT64_MIN = "(-9223372036854775807 - 1)"
+
+ARITHMETIC_OPERATORS = {vm.ADD: "+", vm.SUB: "-", vm.MUL: "*"}
+COMPARISON_OPERATORS = {vm.CMP_EQ: "==", vm.CMP_NE: "!=",
+                        vm.CMP_LT: "<", vm.CMP_LE: "<=",
+                        vm.CMP_GT: ">", vm.CMP_GE: ">="}
+
+_FUNCTIONS: Dict[str, Callable] = {}
+
+log = logging.getLogger(__name__)
+
+
+class UnsupportedProgram(Exception):
+    pass
+
+
+class PythonCodeGenerator:
+    def __init__(self, program: vm.CompiledProgram) -> None:
+        self.program = program
+        self.lines: List[str] = []
+        self.temps = 0
+        # Start positions of instructions, to tell opcodes from arguments
+        self.starts: Set[int] = set()
+        code = program.code
+        ip = 0
+        while ip < len(code):
+            self.starts.add(ip)
+            ip += 2 if code[ip] in vm.HAS_ARG else 1
+
+    def generate(self) -> str:
+        slots = range(len(self.program.names))
+        self.lines = ["from numba import njit", "", "",
+                      "@njit(cache=True)", "def run(out):"]
+        for slot in slots:
+            self.lines.append(f"    v{slot} = 0")
+            self.lines.append(f"    d{slot} = False")
+        self.block(0, len(self.program.code), 1, set())
+        self.lines.append("    return 0")
+        return "\n".join(self.lines) + "\n"
+
+    def temp(self) -> str:
+        self.temps += 1
+        return f"t{self.temps}"
+
+    def block(self, start: int, end: int, indent: int, defined: Set[int]) -> Set[int]:
+        # Emits code[start:end] and returns slots surely assigned after it.
+        # Jumps only come from if statements, so they always point forward.
+        code = self.program.code
+        pad = "    " * indent
+        stack: List[str] = []
+        emitted = len(self.lines)
+        ip = start
+        while ip < end:
+            op = code[ip]
+            if op == vm.LOAD_CONST_NUM:
+                stack.append(repr(self.program.nums[code[ip + 1]]))
+                ip += 2
+            elif op == vm.LOAD_VAR:
+                slot = code[ip + 1]
+                if slot not in defined:
+                    self.lines.append(f"{pad}if not d{slot}:")
+                    self.lines.append(f"{pad}    return {slot + 1}")
+                stack.append(f"v{slot}")
+                ip += 2
+            elif op == vm.STORE_VAR:
+                slot = code[ip + 1]
+                self.lines.append(f"{pad}v{slot} = {stack.pop()}")
+                self.lines.append(f"{pad}d{slot} = True")
+                defined = defined | {slot}
+                ip += 2
+            elif op == vm.CLEAR_VAR:
+                slot = code[ip + 1]
+                self.lines.append(f"{pad}d{slot} = False")
+                defined = defined - {slot}
+                ip += 2
+            elif op in ARITHMETIC_OPERATORS:
+                right = stack.pop()
+                left = stack.pop()
+                result = self.temp()
+                self.lines.append(f"{pad}{result} = {left} {ARITHMETIC_OPERATORS[op]} {right}")
+                if op == vm.ADD:
+                    overflow = f"({left} ^ {result}) & ({right} ^ {result}) < 0"
+                elif op == vm.SUB:
+                    overflow = f"({left} ^ {right}) & ({left} ^ {result}) < 0"
+                else:
+                    overflow = (f"({left} == -1 and {right} == {INT64_MIN}) or "
+                                f"({left} != 0 and {result} // {left} != {right})")
+                self.lines.append(f"{pad}if {overflow}:")
+                self.lines.append(f"{pad}    return {JIT_OVERFLOW}")
+                stack.append(result)
+                ip += 1
+            elif op in COMPARISON_OPERATORS:
+                right = stack.pop()
+                left = stack.pop()
+                stack.append(f"{left} {COMPARISON_OPERATORS[op]} {right}")
+                ip += 1
+            elif op == vm.PRINT:
+                self.lines.append(f"{pad}out.append({stack.pop()})")
+                ip += 1
+            elif op == vm.JMP_IF_FALSE:
+                target = code[ip + 1]
+                self.lines.append(f"{pad}if {stack.pop()}:")
+                # Block with else part ends with jump over it
+                jump = target - 2
+                if jump in self.starts and jump > ip and code[jump] == vm.JMP:
+                    then_defined = self.block(ip + 2, jump, indent + 1, defined)
+                    self.lines.append(f"{pad}else:")
+                    else_defined = self.block(target, code[jump + 1], indent + 1, defined)
+                    defined = then_defined & else_defined
+                    ip = code[jump + 1]
+                else:
+                    self.block(ip + 2, target, indent + 1, defined)
+                    ip = target
+            elif op == vm.HALT:
+                ip += 1
+            else:
+                raise UnsupportedProgram(f"opcode {op} at {ip}")
+        if stack:
+            raise UnsupportedProgram(f"values left on stack at {end}")
+        if len(self.lines) == emitted:
+            self.lines.append(f"{pad}pass")
+        return defined
+
+
+def generate_source(program: vm.CompiledProgram) -> Optional[str]:
+    if any(type(n) is not int or not -2**63 <= n < 2**63 for n in program.nums):
+        return None
+    try:
+        return PythonCodeGenerator(program).generate()
+    except UnsupportedProgram:
+        return None
+
+# ==============================================================================
+#                                JIT
+# ==============================================================================
+def load_function(program: vm.CompiledProgram) -> Optional[Callable]:
+    if importlib.util.find_spec("numba") is None:
+        return None
+    source = generate_source(program)
+    if source is None:
+        return None
+
+    key = hashlib.blake2b(source.encode("utf-8"), digest_size=16).hexdigest()
+    fn = _FUNCTIONS.get(key)
+    if fn is not None:
+        return fn
+
+    # Numba can only cache functions defined in a file, so source is written
+    # out as a module. Its compiled code then lands in __pycache__ next to it
+    # and later processes skip the JIT.
+    path = os.path.join(JIT_CACHE_DIR, f"slj_{key}.py")
+    if not os.path.exists(path):
+        os.makedirs(JIT_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(source)
+        os.replace(tmp_path, path)
+    spec = importlib.util.spec_from_file_location(f"slj_{key}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    fn = _FUNCTIONS[key] = module.run
+    return fn
+
+
+def run_jitted(program: vm.CompiledProgram) -> bool:
+    # Returns False when program can't be run this way, so caller should
+    # use VM. Output is printed only after the run, same as native VM.
+    try:
+        fn = load_function(program)
+        if fn is None:
+            return False
+        import numba
+        from numba.typed import List as TypedList
+        out = TypedList.empty_list(numba.int64)
+        # Numba compiles on first call, so typing errors come from here too
+        status = fn(out)
+    except Exception as error:
+        # Generated module that can't be loaded (e.g. too deeply nested,
+        # broken cache file) or compiled just leaves the program to VM
+        log.debug("cannot run jitted program: %r", error)
+        return False
+    if status == JIT_OVERFLOW:
+        return False
+    vm.write_output(out)
+    if status > 0:
+        raise NameError(f"Undefined variable '{program.names[status - 1]}'")
+    return True
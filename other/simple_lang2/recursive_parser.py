@@ -0,0 +1,308 @@
+
+# ==============================================================================
+#                                IMPORTS
+# ==============================================================================
+
+# Python std lib
+import operator
+import re
+import sys
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Bytecode and virtual machine executing it
+import simple_lang_vm as vm
+
+# ==============================================================================
+#                                TOKENIZER
+# ==============================================================================
+# Same tokens as lexer in SimpleLang.g4, whole source is tokenized in one
+# run of the regex engine. Keywords are matched as ID first and then looked
+# up, like ANTLR picks earlier rule for equally long matches.
+KEYWORDS = {"number": "KW_NUMBER", "text": "KW_TEXT", "print": "KW_PRINT",
+            "if": "KW_IF", "else": "KW_ELSE"}
+
+# type, text, offset in source
+Token = Tuple[str, str, int]
+
+
+def _token(kind: str) -> Callable[[re.Scanner, str], Token]:
+    def action(scanner: re.Scanner, text: str) -> Token:
+        return kind, text, scanner.match.start()
+    return action
+
+
+# Names and operators are interned, so dict lookups on them and comparisons
+# against them can stop at identity check
+def _operator(kind: str) -> Callable[[re.Scanner, str], Token]:
+    def action(scanner: re.Scanner, text: str) -> Token:
+        return kind, sys.intern(text), scanner.match.start()
+    return action
+
+
+def _identifier(scanner: re.Scanner, text: str) -> Token:
+    text = sys.intern(text)
+    return KEYWORDS.get(text, "ID"), text, scanner.match.start()
+
+
+SCANNER = re.Scanner([
+    (r"[ \t]+", None),
+    (r"//[^\r\n]*", None),
+    (r"(?:\r?\n)+", _token("NEWLINE")),
+    (r'"(?:\\.|[^"\\])*"', _token("STRING")),
+    (r"[0-9]+", _token("INT")),
+    (r"[a-zA-Z_][a-zA-Z0-9_]*", _identifier),
+    (r"==|!=|<=|>=|<|>", _operator("OP_COMP")),
+    (r"=", _token("OP_ASSIGN")),
+    (r"[-+*/]", _operator("OP_ARITHM")),
+    (r"\{", _token("BLOCK_START")),
+    (r"\}", _token("BLOCK_END")),
+    (r"\(", _token("PAREN_START")),
+    (r"\)", _token("PAREN_END")),
+], re.DOTALL)
+
+
+def position(source: str, offset: int) -> str:
+    # "line:column" as in ANTLR messages, only needed for errors
+    line = source.count("\n", 0, offset) + 1
+    column = offset - source.rfind("\n", 0, offset) - 1
+    return f"{line}:{column}"
+
+
+def tokenize(source: str) -> List[Token]:
+    tokens, rest = SCANNER.scan(source)
+    if rest:
+        offset = len(source) - len(rest)
+        raise SyntaxError(f"line {position(source, offset)} token recognition error at: '{rest[0]}'")
+    tokens.append(("EOF", "<EOF>", len(source)))
+    return tokens
+
+
+def unescape(value: str) -> str:
+    # String literal contents without quotes
+    if "\\" in value:
+        # unescape using python parsing rules for escape sequences,
+        # characters beyond latin-1 pass through as \u escapes
+        value = value.encode("latin-1", "backslashreplace").decode("unicode_escape")
+    return value
+
+# ==============================================================================
+#                                PARSER
+# ==============================================================================
+FOLD_FUNCTIONS = {vm.ADD: operator.add, vm.SUB: operator.sub,
+                  vm.MUL: operator.mul, vm.DIV: operator.truediv}
+
+# Value of expression which was already emitted, anything else is a constant
+# waiting to be emitted (or folded into a bigger one)
+EMITTED = object()
+
+
+class RecursiveCompiler:
+    # Parses SimpleLang and emits bytecode in one pass, without building a
+    # tree. Produces programs equivalent to ANTLR parser + ConstFolder +
+    # Resolver + SimpleLangCompiler. Expression parsers return (kind, value),
+    # where constants are kept in value instead of being emitted right away,
+    # so arithmetic on them can still be folded. Kind is None when it is only
+    # known at run time.
+    #
+    # Only syntax errors are raised here. Type and name errors must only
+    # happen if the code is reached, so they compile to CHECK_* instructions
+    # and loads of slots nothing was stored to.
+    def __init__(self, source: str) -> None:
+        self.source = source
+        self.tokens = tokenize(source)
+        self.pos = 0
+        self.code: List[int] = []
+        self.nums: List[Any] = []
+        self.strs: List[str] = []
+        self.names: List[str] = []  # name of every slot
+        # Slot of every (name, kind) pair, same as in Resolver
+        self.slots: Dict[Tuple[str, str], int] = {}
+        # Kind of every declared name, None when declarations disagree, same
+        # as in ConstFolder
+        self.kinds: Dict[str, Optional[str]] = {}
+
+    def compile(self) -> vm.CompiledProgram:
+        while self.tokens[self.pos][0] != "EOF":
+            self.parse_statement()
+        self.code.append(vm.HALT)
+        return vm.CompiledProgram(self.code, self.nums, self.strs, self.names)
+
+    # --- helpers ---
+
+    def slot(self, name: str, kind: str) -> int:
+        slot = self.slots.get((name, kind))
+        if slot is None:
+            slot = self.slots[(name, kind)] = len(self.names)
+            self.names.append(name)
+        return slot
+
+    def syntax_error(self, expected: str) -> SyntaxError:
+        _, text, offset = self.tokens[self.pos]
+        return SyntaxError(f"line {position(self.source, offset)} mismatched input '{text}' expecting {expected}")
+
+    def expect(self, kind: str) -> str:
+        token = self.tokens[self.pos]
+        if token[0] != kind:
+            raise self.syntax_error(kind)
+        self.pos += 1
+        return token[1]
+
+    def skip_newlines(self) -> None:
+        # Whitespace or comment between line breaks splits them in two tokens
+        while self.tokens[self.pos][0] == "NEWLINE":
+            self.pos += 1
+
+    def emit(self, op: int, *args: int) -> int:
+        # Returns position of first argument, so jumps can be patched later
+        self.code.append(op)
+        self.code.extend(args)
+        return len(self.code) - len(args)
+
+    def emit_check(self, op: int, message: str) -> None:
+        # Error message is kept among text constants
+        self.strs.append(message)
+        self.emit(op, len(self.strs) - 1)
+
+    def const_instruction(self, kind: str, value: Any) -> Tuple[int, int]:
+        if kind == "number":
+            self.nums.append(value)
+            return vm.LOAD_CONST_NUM, len(self.nums) - 1
+        self.strs.append(value)
+        return vm.LOAD_CONST_STR, len(self.strs) - 1
+
+    def discharge(self, kind: Optional[str], value: Any) -> Optional[str]:
+        # Makes sure expression result is on stack
+        if value is not EMITTED:
+            self.emit(*self.const_instruction(kind, value))
+        return kind
+
+    # --- statements ---
+
+    def parse_statement(self) -> None:
+        kind = self.tokens[self.pos][0]
+        if kind == "KW_NUMBER" or kind == "KW_TEXT":
+            self.parse_var_decl()
+        elif kind == "KW_PRINT":
+            self.pos += 1
+            kind = self.discharge(*self.parse_expr())
+            self.emit(vm.PRINT_TEXT if kind == "text" else vm.PRINT)
+            self.skip_newlines()
+        elif kind == "KW_IF":
+            self.parse_if()
+        else:
+            raise self.syntax_error("{'number', 'text', 'print', 'if'}")
+
+    def parse_var_decl(self) -> None:
+        declared = "number" if self.tokens[self.pos][0] == "KW_NUMBER" else "text"
+        self.pos += 1
+        name = self.expect("ID")
+        self.expect("OP_ASSIGN")
+        kind = self.discharge(*self.parse_expr())
+        self.skip_newlines()
+        other = "text" if declared == "number" else "number"
+        if kind != declared:
+            self.emit_check(vm.CHECK_NUMBER if declared == "number" else vm.CHECK_TEXT,
+                            f"Variable '{name}' declared as {declared} but assigned {other}")
+
+        # Storing to slot of one kind clears the other one, if there is any
+        self.emit(vm.STORE_VAR, self.slot(name, declared))
+        other_slot = self.slots.get((name, other))
+        if other_slot is not None:
+            self.emit(vm.CLEAR_VAR, other_slot)
+        if name in self.kinds and self.kinds[name] != declared:
+            self.kinds[name] = None
+        else:
+            self.kinds[name] = declared
+
+    def parse_if(self) -> None:
+        self.pos += 1
+        left = self.discharge(*self.parse_expr())
+        op = vm.COMPARISON_OPCODES[self.expect("OP_COMP")]
+        right = self.discharge(*self.parse_expr())
+        if left != "number" or right != "number":
+            self.emit_check(vm.CHECK_NUMBERS, "if condition comparisons require numbers")
+        self.emit(op)
+
+        skip_then = self.emit(vm.JMP_IF_FALSE, 0)
+        self.parse_block()
+        if self.tokens[self.pos][0] == "KW_ELSE":
+            self.pos += 1
+            skip_else = self.emit(vm.JMP, 0)
+            self.code[skip_then] = len(self.code)
+            self.parse_block()
+            self.code[skip_else] = len(self.code)
+        else:
+            self.code[skip_then] = len(self.code)
+        self.skip_newlines()
+
+    def parse_block(self) -> None:
+        self.expect("BLOCK_START")
+        self.skip_newlines()
+        while self.tokens[self.pos][0] != "BLOCK_END":
+            self.parse_statement()
+        self.pos += 1
+
+    # --- expressions ---
+    # All arithmetic operators have same precedence and are left associative
+
+    def parse_expr(self) -> Tuple[Optional[str], Any]:
+        kind, value = self.parse_primary()
+        while self.tokens[self.pos][0] == "OP_ARITHM":
+            op = vm.ARITHMETIC_OPCODES[self.tokens[self.pos][1]]
+            self.pos += 1
+            mark = len(self.code)
+            right_kind, right_value = self.parse_primary()
+
+            if value is not EMITTED and right_value is not EMITTED:
+                if kind == "number" and right_kind == "number":
+                    try:
+                        value = FOLD_FUNCTIONS[op](value, right_value)
+                        continue
+                    except ArithmeticError:
+                        # left for run time, it must only fail if executed
+                        pass
+                self.discharge(kind, value)
+                self.discharge(right_kind, right_value)
+            elif value is not EMITTED:
+                # Right side was emitted first, left constant goes before it
+                self.code[mark:mark] = self.const_instruction(kind, value)
+            else:
+                self.discharge(right_kind, right_value)
+
+            if kind != "number" or right_kind != "number":
+                self.emit_check(vm.CHECK_NUMBERS, "'*' and '/' only work on numbers")
+            self.emit(op)
+            kind, value = "number", EMITTED
+        return kind, value
+
+    def parse_primary(self) -> Tuple[Optional[str], Any]:
+        kind, text, _ = self.tokens[self.pos]
+        if kind == "INT":
+            self.pos += 1
+            return "number", int(text)
+        if kind == "STRING":
+            self.pos += 1
+            return "text", unescape(text[1:-1])
+        if kind == "ID":
+            self.pos += 1
+            if text not in self.kinds:
+                # Never declared before, loading always raises NameError
+                self.emit(vm.LOAD_VAR, self.slot(text, "number"))
+                return "number", EMITTED
+            kind = self.kinds[text]
+            if kind is None:
+                self.emit(vm.LOAD_VAR_OR, self.slots[(text, "number")])
+                self.emit(vm.LOAD_VAR, self.slots[(text, "text")])
+            else:
+                self.emit(vm.LOAD_VAR, self.slots[(text, kind)])
+            return kind, EMITTED
+        if kind == "PAREN_START":
+            self.pos += 1
+            result = self.parse_expr()
+            self.expect("PAREN_END")
+            return result
+        raise self.syntax_error("{INT, STRING, ID, '('}")
+
+
+def compile_source(source: str) -> vm.CompiledProgram:
+    return RecursiveCompiler(source).compile()
@@ -4,164 +4,208 @@
 # ==============================================================================
 
 # Python std lib
+import contextlib
+import hashlib
+import io
+import os
+import pickle
 import sys
-from dataclasses import dataclass
-from typing import Any, Dict
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional, Tuple
 
-# ANTLR 4 general imports
-from antlr4 import FileStream, CommonTokenStream, InputStream
-from antlr4.error.ErrorListener import ErrorListener
+# Bytecode and virtual machine executing it
+import simple_lang_vm as vm
 
-# ANTL 4 generated grammar
-from antlr_grammar.SimpleLangLexer import SimpleLangLexer
-from antlr_grammar.SimpleLangParser import SimpleLangParser
-from antlr_grammar.SimpleLangVisitor import SimpleLangVisitor
-
-# ==============================================================================
-#                                INTERPRETER
-# ==============================================================================
-class ThrowingErrorListener(ErrorListener):
-    def syntaxError(self, recognizer, offendingSymbol, line, column, msg, e):
-        raise SyntaxError(f"line {line}:{column} {msg}")
+# Hand written parser compiling straight to bytecode
+from recursive_parser import compile_source
 
+# Parse tree based interpreter and compiler (antlr_tree.py) need ANTLR
+# runtime, which is slow to import, so they are only loaded when used.
+# Their names are still available as attributes of this module.
+ANTLR_TREE_NAMES = frozenset((
+    "ThrowingErrorListener", "UnknownOperatorError", "COMPARISON_FUNCTIONS",
+    "ARITHMETIC_FUNCTIONS", "Variable", "SimpleLangInterpreter",
+    "ConstFolder", "Resolver", "SimpleLangCompiler"))
 
-@dataclass
-class Variable:
-    kind: str  # "number" or "text"
-    value: Any
 
-class SimpleLangInterpreter(SimpleLangVisitor):
-    def __init__(self) -> None:
-        self.env: Dict[str, Variable] = {}
+def __getattr__(name: str) -> Any:
+    if name in ANTLR_TREE_NAMES:
+        import antlr_tree
+        return getattr(antlr_tree, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-    # program: statement* EOF
-    def visitProgram(self, ctx: SimpleLangParser.ProgramContext):
-        for st in ctx.statement():
-            self.visit(st)
-        return None
+# ==============================================================================
+#                                COMPILE CACHE
+# ==============================================================================
+# Bump when bytecode or CompiledProgram changes, so old cache entries are
+# never loaded
+SCHEMA_VERSION = 4
+COMPILE_CACHE_SIZE = 128
+COMPILE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "simplelang")
 
-    # --- statements ---
+_COMPILE_CACHE: "OrderedDict[bytes, vm.CompiledProgram]" = OrderedDict()
 
-    def visitVarDecl(self, ctx: SimpleLangParser.VarDeclContext):
-        name = ctx.ID().getText()
-        expr_val = self.visit(ctx.expr())
 
-        if ctx.KW_NUMBER() is not None:
-            if expr_val.kind != "number":
-                raise TypeError(f"Variable '{name}' declared as number but assigned {expr_val.kind}")
-            self.env[name] = expr_val
-        else:
-            # text
-            if expr_val.kind != "text":
-                raise TypeError(f"Variable '{name}' declared as text but assigned {expr_val.kind}")
-            self.env[name] = expr_val
+def source_key(source: str) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(SCHEMA_VERSION.to_bytes(4, "little"))
+    h.update(source.encode("utf-8"))
+    return h.digest()
 
-        return None
 
-    def visitPrintStmt(self, ctx: SimpleLangParser.PrintStmtContext):
-        v = self.visit(ctx.expr())
-        print(v.value)
-        return None
+def load_cached_program(key: bytes) -> Optional[vm.CompiledProgram]:
+    program = _COMPILE_CACHE.get(key)
+    if program is not None:
+        _COMPILE_CACHE.move_to_end(key)
+        return program
 
-    def visitIfStmt(self, ctx: SimpleLangParser.IfStmtContext):
-        cond = self.visit(ctx.condition())
-        if cond:
-            self.visit(ctx.block(0))
-        else:
-            if ctx.KW_ELSE() is not None:
-                self.visit(ctx.block(1))
+    try:
+        with open(os.path.join(COMPILE_CACHE_DIR, key.hex() + ".slc"), "rb") as f:
+            program = pickle.load(f)
+    except Exception:
+        # Missing, unreadable or stale file, program is just compiled again
         return None
-
-    def visitBlock(self, ctx: SimpleLangParser.BlockContext):
-        for st in ctx.statement():
-            self.visit(st)
+    if not isinstance(program, vm.CompiledProgram):
         return None
-
-    # --- condition ---
-    def visitCondition(self, ctx: SimpleLangParser.ConditionContext) -> bool:
-        left = self.visit(ctx.expr(0))
-        right = self.visit(ctx.expr(1))
-        if left.kind != "number" or right.kind != "number":
-            raise TypeError("if condition comparisons require numbers")
-
-        op = ctx.OP_COMP().getText()
-        a = left.value
-        b = right.value
-
-        if op == "==":
-            return a == b
-        if op == "!=":
-            return a != b
-        if op == "<":
-            return a < b
-        if op == "<=":
-            return a <= b
-        if op == ">":
-            return a > b
-        if op == ">=":
-            return a >= b
-        raise RuntimeError(f"Unknown comparison operator: {op}")
-
-    # --- expressions ---
-    def visitIntLit(self, ctx: SimpleLangParser.IntLitContext) -> Variable:
-        return Variable("number", int(ctx.INT().getText()))
-
-    def visitStringLit(self, ctx: SimpleLangParser.StringLitContext) -> Variable:
-        raw = ctx.STRING().getText()  # includes quotes
-        # simple unescape using python parsing rules for escape sequences
-        s = bytes(raw[1:-1], "utf-8").decode("unicode_escape")
-        return Variable("text", s)
-
-    def visitVarRef(self, ctx: SimpleLangParser.VarRefContext) -> Variable:
-        name = ctx.ID().getText()
-        if name not in self.env:
-            raise NameError(f"Undefined variable '{name}'")
-        return self.env[name]
-
-    def visitParens(self, ctx: SimpleLangParser.ParensContext) -> Variable:
-        return self.visit(ctx.expr())
-
-    def visitArithmOp(self, ctx: SimpleLangParser.ArithmOpContext) -> Variable:
-        left = self.visit(ctx.expr(0))
-        right = self.visit(ctx.expr(1))
-        if left.kind != "number" or right.kind != "number":
-            raise TypeError("'*' and '/' only work on numbers")
-
-        op = ctx.OP_ARITHM().getText()
-        if op == '+':
-            return Variable("number", left.value + right.value)
-        if op == '-':
-            return Variable("number", left.value - right.value)
-        if op == '*':
-            return Variable("number", left.value * right.value)
-        if op == '/':
-            return Variable("number", left.value / right.value)
-        
-        raise RuntimeError(f"Unexpected operator {op}")
+    store_cached_program(key, program, persist=False)
+    return program
+
+
+def store_cached_program(key: bytes, program: vm.CompiledProgram, persist: bool = True) -> None:
+    _COMPILE_CACHE[key] = program
+    if len(_COMPILE_CACHE) > COMPILE_CACHE_SIZE:
+        _COMPILE_CACHE.popitem(last=False)
+    if not persist:
+        return
+
+    path = os.path.join(COMPILE_CACHE_DIR, key.hex() + ".slc")
+    try:
+        os.makedirs(COMPILE_CACHE_DIR, exist_ok=True)
+        # Write to temporary file first, so a reader never sees half of it
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(program, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
 
 # ==============================================================================
 #                                MAIN
 # ==============================================================================
-def run_interpreter(source: str) -> None:
-    lexer = SimpleLangLexer(InputStream(source))
-    stream = CommonTokenStream(lexer)
-    parser = SimpleLangParser(stream)
+def parse(source: str) -> Any:
+    # ANTLR parse tree (SimpleLangParser.ProgramContext)
+    import antlr_tree
+    return antlr_tree.parse(source)
+
+
+def read_source(path: str) -> str:
+    # Whole file is read in one go and decoded once, instead of going
+    # through buffered text layer in chunks
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        chunks = []
+        while True:
+            chunk = os.read(fd, max(size, 1))
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+    return b"".join(chunks).decode("utf-8")
+
+
+def compile_program(source: str, use_antlr: bool = False) -> vm.CompiledProgram:
+    if use_antlr:
+        # Slower, kept to cross-check against grammar
+        import antlr_tree
+        return antlr_tree.compile_tree(source)
+    return compile_source(source)
+
+
+def run_interpreter(source: str, use_bytecode: bool = True, use_jit: bool = False,
+                    use_antlr: bool = False) -> None:
+    if not use_bytecode:
+        import antlr_tree
+        antlr_tree.interpret(source)
+        return
+
+    # Same source always compiles to same program, so parsing and compiling
+    # is skipped for anything seen before
+    key = source_key(source)
+    program = load_cached_program(key)
+    if program is None:
+        program = compile_program(source, use_antlr)
+        store_cached_program(key, program)
+    # JIT pays off only for long running number programs, so it is opt-in
+    if use_jit:
+        # Imported only here, it brings in Numba when installed
+        import codegen_py
+        if codegen_py.run_jitted(program):
+            return
+    vm.execute(program)
 
-    lexer.removeErrorListeners()
-    parser.removeErrorListeners()
-    lexer.addErrorListener(ThrowingErrorListener())
-    parser.addErrorListener(ThrowingErrorListener())
 
-    tree = parser.program()
-    interp = SimpleLangInterpreter()
-    interp.visit(tree)
+# ==============================================================================
+#                                CROSS CHECK
+# ==============================================================================
+# Programs where kind of a variable changes, or kinds only known at run time
+# decide if they fail. Both compilers must run them exactly like the tree
+# walking interpreter, which follows the grammar most directly.
+CROSS_CHECK_PROGRAMS = [
+    'number x = 1\nprint x\ntext x = "a"\nprint x\n',
+    'text x = "a"\nnumber x = 2\nprint x * 3\ntext y = x\n',
+    'text x = "a"\nif 1 < 2 { number x = 2 }\nprint x + 1\n',
+    'number x = 1\nif 2 < 1 { text x = "a" }\nprint x * 2\n',
+    'number x = 1\nif 1 < 2 { text x = "a" }\nprint x\nprint x * 2\n',
+    'if 1 < 2 { number x = 1 } else { text x = "a" }\nprint x\ntext x = "b"\nnumber y = x\n',
+    'number x = 1\nif 1 > 2 { print "a" + 1 }\ntext x = "b"\nprint x\n',
+    'number x = 1\nif x > 1 { print y }\ntext x = "c"\nprint x\nif x == 1 { }\n',
+    'text x = "a"\nnumber x = 1\ntext x = "b"\nif 1 < 2 { number x = 2 }\nprint x\nprint z\n',
+]
+
+
+def capture_output(run: Callable[[], None]) -> Tuple[str, Optional[str]]:
+    # Printed text and error raised, if any
+    out = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(out):
+            run()
+    except Exception as e:
+        return out.getvalue(), f"{type(e).__name__}: {e}"
+    return out.getvalue(), None
+
+
+def cross_check(source: str) -> List[str]:
+    # Returns names of paths which behave differently than tree walker.
+    # Compile cache is bypassed, so each path compiles the source itself.
+    expected = capture_output(lambda: run_interpreter(source, use_bytecode=False))
+    mismatches = []
+    for name, use_antlr in (("recursive", False), ("antlr", True)):
+        compile_ = lambda: compile_program(source, use_antlr)
+        if capture_output(lambda: vm.execute(compile_())) != expected:
+            mismatches.append(name)
+        if capture_output(lambda: vm.run_python(compile_())) != expected:
+            mismatches.append(f"{name} (python vm)")
+    return mismatches
 
 
 if __name__ == "__main__":
 
-    if len(sys.argv) != 2:
-        print("Usage: python interpreter.py <file.sl>")
+    if len(sys.argv) >= 2 and sys.argv[1] == "--cross-check":
+        sources = [read_source(path) for path in sys.argv[2:]] or CROSS_CHECK_PROGRAMS
+        failed = False
+        for source in sources:
+            mismatches = cross_check(source)
+            if mismatches:
+                failed = True
+                print(f"{', '.join(mismatches)} differ on: {source!r}")
+        sys.exit(1 if failed else 0)
+
+    use_jit = len(sys.argv) == 3 and sys.argv[1] == "--jit"
+    if len(sys.argv) != 2 and not use_jit:
+        print("Usage: python interpreter.py [--jit] <file.sl>")
+        print("       python interpreter.py --cross-check [<file.sl> ...]")
         sys.exit(2)
 
-    with open(sys.argv[1], "r", encoding="utf-8") as f:
-        run_interpreter(f.read())
\ No newline at end of file
+    run_interpreter(read_source(sys.argv[-1]), use_jit=use_jit)
\ No newline at end of file
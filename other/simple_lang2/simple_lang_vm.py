@@ -0,0 +1,255 @@
+
+# ==============================================================================
+#                                IMPORTS
+# ==============================================================================
+
+# Python std lib
+import sys
+from array import array
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+# Native VM, optional (see _simple_lang_vm.c for build command)
+try:
+    import _simple_lang_vm
+except ImportError:
+    _simple_lang_vm = None
+
+# ==============================================================================
+#                                BYTECODE
+# ==============================================================================
+# Program is a flat list of ints. Instructions marked with "arg" are followed
+# by a single argument stored in the next list element.
+LOAD_CONST_NUM = 0  # arg: index in nums
+LOAD_CONST_STR = 1  # arg: index in strs
+LOAD_VAR = 2        # arg: variable slot
+STORE_VAR = 3       # arg: variable slot
+ADD = 4
+SUB = 5
+MUL = 6
+DIV = 7
+PRINT = 8
+CMP_EQ = 9
+CMP_NE = 10
+CMP_LT = 11
+CMP_LE = 12
+CMP_GT = 13
+CMP_GE = 14
+JMP = 15            # arg: target position in code
+JMP_IF_FALSE = 16   # arg: target position in code
+HALT = 17
+PRINT_TEXT = 18
+CLEAR_VAR = 19      # arg: variable slot
+# Variable of kind unknown before running: pushes value of number slot in
+# arg and skips next instruction, which is LOAD_VAR of its text slot
+LOAD_VAR_OR = 20    # arg: variable slot
+# Raise TypeError with message strs[arg] unless values on top of stack
+# have the right kind
+CHECK_NUMBERS = 21  # arg: index in strs, checks two values
+CHECK_NUMBER = 22   # arg: index in strs
+CHECK_TEXT = 23     # arg: index in strs
+
+HAS_ARG = frozenset((LOAD_CONST_NUM, LOAD_CONST_STR, LOAD_VAR, STORE_VAR,
+                     JMP, JMP_IF_FALSE, CLEAR_VAR, LOAD_VAR_OR,
+                     CHECK_NUMBERS, CHECK_NUMBER, CHECK_TEXT))
+
+# Opcodes of operator tokens
+COMPARISON_OPCODES = {"==": CMP_EQ, "!=": CMP_NE,
+                      "<": CMP_LT, "<=": CMP_LE,
+                      ">": CMP_GT, ">=": CMP_GE}
+ARITHMETIC_OPCODES = {"+": ADD, "-": SUB, "*": MUL, "/": DIV}
+
+
+@dataclass
+class CompiledProgram:
+    code: List[int]
+    nums: List[Any]   # number constants (int or float)
+    strs: List[str]   # text constants
+    names: List[str]  # variable name of every slot, for error messages
+    # Same code packed for native VM, None if it can't run there
+    native_code: Optional[bytes] = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.native_code = pack_native(self)
+
+
+# Native VM instruction is uint32 with opcode in low 6 bits and argument in
+# remaining 26. It works on int64 only, so programs with division (which
+# gives floats), constants that don't fit or values whose kind is only
+# known at run time stay in Python VM.
+NATIVE_OPCODE_BITS = 6
+NATIVE_MAX_ARG = (1 << 26) - 1
+NATIVE_OVERFLOW = -1
+NATIVE_UNSUPPORTED = frozenset((DIV, LOAD_VAR_OR, CHECK_NUMBERS, CHECK_NUMBER, CHECK_TEXT))
+
+
+def pack_native(program: CompiledProgram) -> Optional[bytes]:
+    if any(type(n) is not int or not -2**63 <= n < 2**63 for n in program.nums):
+        return None
+    code = program.code
+    instructions: List[Tuple[int, int]] = []
+    # Jump targets point to list positions, native ones to instruction numbers
+    positions: Dict[int, int] = {}
+    ip = 0
+    while ip < len(code):
+        op = code[ip]
+        positions[ip] = len(instructions)
+        if op in NATIVE_UNSUPPORTED:
+            return None
+        if op in HAS_ARG:
+            instructions.append((op, code[ip + 1]))
+            ip += 2
+        else:
+            instructions.append((op, 0))
+            ip += 1
+    positions[len(code)] = len(instructions)
+
+    packed = array("I")
+    for op, arg in instructions:
+        if op == JMP or op == JMP_IF_FALSE:
+            arg = positions[arg]
+        if arg > NATIVE_MAX_ARG:
+            return None
+        packed.append(arg << NATIVE_OPCODE_BITS | op)
+    return packed.tobytes()
+
+# ==============================================================================
+#                                VIRTUAL MACHINE
+# ==============================================================================
+# Printed values are buffered and written together, at the latest after
+# this many of them
+OUTPUT_BUFFER_SIZE = 1024
+
+
+def write_output(values: List[Any]) -> None:
+    if values:
+        sys.stdout.write("\n".join(map(str, values)) + "\n")
+
+
+def execute(program: CompiledProgram) -> None:
+    if _simple_lang_vm is not None and program.native_code is not None:
+        if run_native(program):
+            return
+    run_python(program)
+
+
+def run_native(program: CompiledProgram) -> bool:
+    # Printed values are collected and written only after whole program ran,
+    # so on int64 overflow nothing is printed yet and the program can be
+    # rerun by Python VM (which has unbounded ints). Returns False then.
+    out: List[Any] = []
+    status = _simple_lang_vm.run(program.native_code, program.nums,
+                                 program.strs, len(program.names), out)
+    if status == NATIVE_OVERFLOW:
+        return False
+    write_output(out)
+    if status > 0:
+        raise NameError(f"Undefined variable '{program.names[status - 1]}'")
+    return True
+
+
+def run_python(program: CompiledProgram) -> None:
+    code = program.code
+    nums = program.nums
+    strs = program.strs
+    # Variables and stack hold plain Python values, kinds that weren't known
+    # during compilation are checked by CHECK_* instructions
+    env: List[Any] = [None] * len(program.names)
+    stack: List[Any] = []
+    push = stack.append
+    pop = stack.pop
+
+    out: List[Any] = []
+    ip = 0
+    try:
+        while True:
+            op = code[ip]
+            ip += 1
+            # Most frequent instructions are checked first
+            if op == LOAD_VAR:
+                value = env[code[ip]]
+                if value is None:
+                    raise NameError(f"Undefined variable '{program.names[code[ip]]}'")
+                push(value)
+                ip += 1
+            elif op == LOAD_CONST_NUM:
+                push(nums[code[ip]])
+                ip += 1
+            elif op == STORE_VAR:
+                env[code[ip]] = pop()
+                ip += 1
+            # Arithmetic in order of how common it is in typical programs
+            elif op == ADD:
+                right = pop()
+                stack[-1] = stack[-1] + right
+            elif op == MUL:
+                right = pop()
+                stack[-1] = stack[-1] * right
+            elif op == SUB:
+                right = pop()
+                stack[-1] = stack[-1] - right
+            elif op == DIV:
+                right = pop()
+                stack[-1] = stack[-1] / right
+            elif op == JMP_IF_FALSE:
+                if pop():
+                    ip += 1
+                else:
+                    ip = code[ip]
+            elif op == LOAD_CONST_STR:
+                push(strs[code[ip]])
+                ip += 1
+            elif op == PRINT or op == PRINT_TEXT:
+                out.append(pop())
+                if len(out) >= OUTPUT_BUFFER_SIZE:
+                    write_output(out)
+                    out.clear()
+            elif op == JMP:
+                ip = code[ip]
+            elif op == CMP_EQ:
+                right = pop()
+                stack[-1] = stack[-1] == right
+            elif op == CMP_NE:
+                right = pop()
+                stack[-1] = stack[-1] != right
+            elif op == CMP_LT:
+                right = pop()
+                stack[-1] = stack[-1] < right
+            elif op == CMP_LE:
+                right = pop()
+                stack[-1] = stack[-1] <= right
+            elif op == CMP_GT:
+                right = pop()
+                stack[-1] = stack[-1] > right
+            elif op == CMP_GE:
+                right = pop()
+                stack[-1] = stack[-1] >= right
+            elif op == CLEAR_VAR:
+                env[code[ip]] = None
+                ip += 1
+            elif op == LOAD_VAR_OR:
+                value = env[code[ip]]
+                if value is None:
+                    ip += 1
+                else:
+                    push(value)
+                    ip += 3
+            # Text values are str, numbers are int or float
+            elif op == CHECK_NUMBERS:
+                if type(stack[-1]) is str or type(stack[-2]) is str:
+                    raise TypeError(strs[code[ip]])
+                ip += 1
+            elif op == CHECK_NUMBER:
+                if type(stack[-1]) is str:
+                    raise TypeError(strs[code[ip]])
+                ip += 1
+            elif op == CHECK_TEXT:
+                if type(stack[-1]) is not str:
+                    raise TypeError(strs[code[ip]])
+                ip += 1
+            elif op == HALT:
+                return
+            else:
+                raise RuntimeError(f"Unknown opcode {op} at {ip - 1}")
+    finally:
+        write_output(out)
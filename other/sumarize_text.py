@@ -19,7 +19,7 @@ import re
 import sys
 from dataclasses import dataclass
 from enum import Enum, auto
-from typing import Final, Optional, Set, List
+from typing import Dict, Final, Optional, Set, List
 from collections import Counter
 
 # NLTK
@@ -31,6 +31,8 @@ from nltk import pos_tag
 # Other libraries
 from heapq import nlargest
 
+logger = logging.getLogger(__name__)
+
 # ==================================================================================================
 #                                      NLTK RESOURCES 
 # ==================================================================================================
@@ -144,7 +146,7 @@ class WordFilter:
     def __call__(self, text: List[str]|str)-> List[str]|str:
         working_on_list = self.working_on_list_
         tokens = text if working_on_list else word_tokenize(text)
-        print(tokens)
+        logger.debug('%s', tokens)
         filtered = [word for word in tokens if word not in self.stop_words_]
         pos_tags = pos_tag(filtered)
         filtered = [word for word, pos in pos_tags if pos in self.allowed_tags_]
@@ -170,32 +172,32 @@ def process_text_file(source_text: str, cfg: Config)-> Dict[str, float] :
         word_counts[i]=(word_counts[i]/max_count)
     return word_counts
 
+# Maps every whitespace character to plain space (all of them are below U+3001)
+WHITESPACE_TABLE: Final[Dict[int, str]] = {i: ' ' for i in range(0x3001) if chr(i).isspace()}
+# After translation above, collapses runs of spaces to one and drops symbols
+# (unmatched group is replaced with empty string)
+CLEANUP_RE: Final[re.Pattern] = re.compile(r'( ) *|[^\w\s]+')
+
+def clean_sentence(sentence: str) -> str:
+    return CLEANUP_RE.sub(r'\1', sentence.lower().translate(WHITESPACE_TABLE))
+
 def get_tokenized_sentences(source_text: str, cfg: Config):
-    endlines = re.compile(r'\n')
-    whitespaces = re.compile(r'[\s]+')
-    misc_symbols = re.compile(r'[^\w\s]+') 
     allowed_words = WordFilter(False, lang=cfg.lang, extra_stopwords=cfg.stopwords)
 
     sentences = sent_tokenize(source_text)
-    tokenized = map(lambda s: s.lower(), sentences)
-    tokenized = map(lambda s: endlines.sub(' ', s), tokenized)
-    tokenized = map(lambda s: whitespaces.sub(' ', s), tokenized)
-    tokenized = map(lambda s: misc_symbols.sub('', s), tokenized)
+    tokenized = map(clean_sentence, sentences)
     tokenized = map(allowed_words, tokenized)
     sentences = [(s,t) for s,t in zip(sentences, tokenized)]
     return sentences
 
 def calculate_scores(word_scores, sentences):
     sent_strength={}
-    print(sentences)
+    logger.debug('%s', sentences)
     for sent in sentences:
-        for word in sent[1].split(' '):
-           # print(word)
-            if word in word_scores.keys():
-                if sent in sent_strength.keys():
-                    sent_strength[sent]+=word_scores[word]
-                else:
-                    sent_strength[sent]=word_scores[word]
+        scores = [word_scores[word] for word in sent[1].split() if word in word_scores]
+        # Only sentences with at least one scored word get ranked
+        if scores:
+            sent_strength[sent] = sent_strength.get(sent, 0) + sum(scores)
     return sent_strength
 
 
@@ -206,18 +208,17 @@ def calculate_scores(word_scores, sentences):
 
 def main(argv: Optional[Sequence[str]] = None) -> None:
     cfg: Config = Config.from_args()
-    print(cfg)
+    logger.debug('%s', cfg)
     text = ''
     with open(cfg.source_text, 'r') as txt:
         text = txt.read()
     word_scores = process_text_file(text, cfg)
-    print(f'Word scores size = {len(word_scores)}')
+    logger.debug('Word scores size = %d', len(word_scores))
     sentences = get_tokenized_sentences(text,cfg)
-    print(len(sentences))
+    logger.debug('Sentences = %d', len(sentences))
     sentence_scores = calculate_scores(word_scores, sentences)
-    print(len(sentence_scores))
+    logger.debug('Scored sentences = %d', len(sentence_scores))
     sorted_sentences = sorted(sentence_scores.items(), key=lambda kv: (kv[1], kv[0]), reverse=True)
-    print(len(sorted_sentences))
     top_10 = sorted_sentences[:10]
     for sentence in top_10:
         print('-------------------------------------')